@@ -1,10 +1,16 @@
 # Emma Western June 24, 2014 Version 1.0
 # Create a master dark fits file from images that have the same exposure time and print the
 # number of outliers to the screen
+# build_masters() builds all the master bias, dark and flat frames of a night at once
 ##########
 
 import os
+import multiprocessing
 from astropy.io import fits
+import instrument
+from header_index import HeaderIndex
+from fits_access import MappedImage, header_records, observation_night
+from fits_access import prefetch, StripReader, PREFETCH_DEPTH, frame_type, forget_listings
 import numpy as np
 
 #################       UPDATE PATH AND FILENAME AND EXPOSURE TIME        #################3
@@ -19,7 +25,11 @@ import numpy as np
 #   allFiles - all the files in the path
 #   allFits - all the fits files in the path
 #   images - all the fits files with the desired exposure time in the path
-#   mean - the mean of all the images' data
+#   index - header index kept in path so re-runs only read new files
+#   method - how the images are combined, see combine()
+#   mean - the combined images' data
+#   stats - pixel rejection statistics of the combine
+#   mask - hot pixels of the master dark, saved with it as the BPM extension
 # RETURNS
 #   nothing
 ##########
@@ -28,14 +38,22 @@ def main():
     path = '/raid/data/home/observatory/software/Scripts/Emmas_Scripts/Fits_files/DarksMinusBias_Test7'
     path2 = '/raid/data/home/observatory/software/Scripts/Emmas_Scripts/Fits_files'
     filename = 'MasterDark_180s_Test7_Dark-Bias.fit'
+    method = 'mean'
     
     allFiles = os.listdir(path)
     allFits = sort(allFiles)
-    images = onlySixHundred(allFits, path)
+    index = HeaderIndex(path)
+    images = onlySixHundred(allFits, path, index)
+    index.close()
     
-    mean = getmean(images, path)
+    mean, stats = combine(images, path, method)
+    print '%(method)s of %(ncombine)d frames, %(rejected)d values rejected (%(fraction).4f)' % stats
+    print 'rejected per frame: ' + str(stats['per_frame'])
     outliers(mean) 
-    master_dark(mean, path2, filename)
+    mask = bad_pixel_mask(mean)
+    master_dark(mean, path2, filename, stats, mask)
+    if instrument.enabled():
+        instrument.print_report()
     
     
     
@@ -67,17 +85,27 @@ def sort(allFiles):
 # PARAMETERS
 #   allFits - list of all the fits files in the path
 #   path - where the program looked to find the fits files
+#   index - header index to select from (optional)
+#   wanted - files in the index with the desired exposure time
 #   images - list of fits files with a certain exposure time
 #   x - combines the path and image name so the program can open the file
-#   hdulist - opens a fits file
 #   head - header of a fits file
 #   exp - the exposure time of a fits file
 # RETURN
 #   list of fits files with a certain exposure time
 ##########
     
-def onlySixHundred(allFits, path):
+def onlySixHundred(allFits, path, index=None):
     images = []
+
+    # indexed lookup: only new or changed files are opened
+    if index is not None:
+        index.update(allFits, path)
+        wanted = set(index.select(EXPOSURE=180.0))
+        for i in allFits:
+            if os.path.abspath(os.path.join(path, i)) in wanted:
+                images.append(i)
+        return images
     
     for i in allFits:
         x = os.path.join(path, i)
@@ -95,14 +123,19 @@ def onlySixHundred(allFits, path):
     
 ##########
 # DESCRIPTION
-#   Finds the mean for the fits files
+#   Finds the mean for the fits files. The frames are memory mapped and read
+#   in strips of rows that are added into one running sum in place, so memory
+#   use stays the same no matter how many frames there are. The next strips
+#   are read in the background while the current one is added
 # PARAMETERS
 #   images - list of fits files with certain exposure time
 #   path - where the program looked to find the files
-#   info - list of data from fits files
-#   x - combines file name and path so the file can be opened
-#   hdulist - opens a fits file
-#   data - data of a fits file
+#   strip_rows - how many rows of a frame are read at a time
+#   depth - how many strips are read ahead
+#   dtype - type the sum is kept in; np.float32 halves the memory used
+#   strips - (file, first row, last row) of every strip to read
+#   reader - reads one strip, keeping the current file open
+#   strip - a strip of rows of a fits file
 #   dimensions - dimensions of fits file data
 #   sum - the sum of all the data
 #   n - how many images there are
@@ -110,51 +143,202 @@ def onlySixHundred(allFits, path):
 # RETURN
 #   mean
 ##########    
-    
-def getmean(images, path):
+
+# rows read at a time; 256 rows of a 4k x 4k frame is 8 MB as float64
+STRIP_ROWS = 256
+
+@instrument.stage
+def getmean(images, path, strip_rows=STRIP_ROWS, depth=PREFETCH_DEPTH, dtype=np.float64):
     
     # just to find the dimensions to create sum
-    hdulist = fits.open(os.path.join(path, images[0]))
-    data = hdulist[0].data
-    hdulist.close()
-    
-    dimensions = data.shape
-    sum = np.zeros(dimensions)
-    
-    for i in images:
-        x = os.path.join(path, i)
-        hdulist = fits.open(x)
-        data = hdulist[0].data
-        sum = sum + data
-        hdulist.close()
+    dimensions = frame_shape(os.path.join(path, images[0]))
+    sum = np.zeros(dimensions, dtype)
+
+    strips = [(os.path.join(path, i), r, r + strip_rows)
+              for i in images for r in range(0, dimensions[0], strip_rows)]
+    reader = StripReader(dimensions, dtype)
+    try:
+        for (x, r0, r1), strip in prefetch(strips, reader, depth):
+            np.add(sum[r0:r1], strip, out=sum[r0:r1])
+    finally:
+        reader.close()
         
     n = len(images)
-    mean = sum / n
+    sum /= n
+    mean = sum
 
     return mean    
+
+
+##########
+# DESCRIPTION
+#   reads the data dimensions from the header without reading the data
+# PARAMETERS
+#   x - input file
+# RETURN
+#   dimensions as (rows, columns)
+##########
+
+def frame_shape(x):
+    with MappedImage(x) as image:
+        return image.shape
     
     
     
+##########
+# DESCRIPTION
+#   Combines the fits files with a robust method. The frames are memory mapped
+#   and the stack is built one tile of rows at a time, so only tile_bytes of
+#   pixels are in memory at once
+#       'mean'   - plain mean (same as getmean)
+#       'median' - median of every pixel
+#       'sigclip'- mean after iteratively rejecting values more than sigma
+#                  standard deviations from the median
+#       'minmax' - mean after rejecting the nlow lowest and nhigh highest values
+# PARAMETERS
+#   images - list of fits files with certain exposure time
+#   path - where the program looked to find the files
+#   method - one of the methods above
+#   sigma - rejection threshold for 'sigclip'
+#   iters - most rejection passes for 'sigclip'
+#   nlow, nhigh - how many values 'minmax' rejects at each pixel
+#   tile_bytes - size of the stack tile held in memory
+#   dtype - type of the arithmetic and of master; by default the stack is
+#           float32 and the master float64, np.float32 makes both float32
+#   images - the memory mapped fits files
+#   stack - one tile of rows from every frame
+#   rejected - how many values were rejected from each frame
+# RETURN
+#   master, stats - the combined data and a dictionary of rejection statistics
+##########
+
+# bytes of the stack tile held in memory at once
+TILE_BYTES = 512 * 1024**2
+
+COMBINE_METHODS = ('mean', 'median', 'sigclip', 'minmax')
+
+@instrument.stage
+def combine(images, path, method='mean', sigma=3.0, iters=5, nlow=1, nhigh=1,
+            tile_bytes=TILE_BYTES, dtype=None):
+    if method not in COMBINE_METHODS:
+        raise ValueError('unknown combine method %r' % method)
+
+    n = len(images)
+    if method == 'minmax' and n <= nlow + nhigh:
+        raise ValueError('minmax needs more than %d frames' % (nlow + nhigh))
+
+    if method == 'mean':
+        master = getmean(images, path, dtype=dtype or np.float64)
+        rejected = np.zeros(n, dtype=np.int64)
+        return master, rejection_stats(method, rejected, master.size)
+
+    work = np.dtype(dtype or np.float32)
+    dimensions = frame_shape(os.path.join(path, images[0]))
+    rows = max(1, tile_bytes // (n * dimensions[1] * work.itemsize))
+    master = np.zeros(dimensions, dtype or np.float64)
+    rejected = np.zeros(n, dtype=np.int64)
+
+    mapped = []
+    try:
+        for i in images:
+            mapped.append(MappedImage(os.path.join(path, i)))
+            if mapped[-1].shape != dimensions:
+                raise ValueError('%s is %s, expected %s' % (i, mapped[-1].shape, dimensions))
+
+        for r in range(0, dimensions[0], rows):
+            stack = np.array([m.rows(r, r + rows, work) for m in mapped], dtype=work)
+
+            if method == 'median':
+                master[r:r + rows] = np.median(stack, axis=0)
+
+            elif method == 'sigclip':
+                for it in range(iters):
+                    center = np.nanmedian(stack, axis=0)
+                    spread = np.nanstd(stack, axis=0)
+                    with np.errstate(invalid='ignore'):
+                        bad = np.abs(stack - center) > sigma * spread
+                    if not bad.any():
+                        break
+                    stack[bad] = np.nan
+                master[r:r + rows] = np.nanmean(stack, axis=0, dtype=master.dtype)
+                rejected += np.isnan(stack).sum(axis=(1, 2))
+
+            elif method == 'minmax':
+                order = np.argsort(stack, axis=0)
+                stack.sort(axis=0)
+                master[r:r + rows] = stack[nlow:n - nhigh].mean(axis=0, dtype=master.dtype)
+                dropped = np.concatenate((order[:nlow], order[n - nhigh:])).ravel()
+                rejected += np.bincount(dropped, minlength=n)
+    finally:
+        for m in mapped:
+            m.close()
+
+    return master, rejection_stats(method, rejected, master.size)
+
+
+##########
+# DESCRIPTION
+#   builds the rejection statistics that combine() reports
+# PARAMETERS
+#   method - combine method used
+#   rejected - how many values were rejected from each frame
+#   npix - number of pixels in one frame
+# RETURN
+#   dictionary of statistics
+##########
+
+def rejection_stats(method, rejected, npix):
+    n = len(rejected)
+    stats = {}
+    stats['method'] = method
+    stats['ncombine'] = n
+    stats['rejected'] = int(rejected.sum())
+    stats['fraction'] = stats['rejected'] / float(n * npix)
+    stats['per_frame'] = [int(x) for x in rejected]
+    return stats
+
+
 ##########
 # DESCRIPTION
 #   find how many outliers there are based a threshold and print them
 # PARAMETERS
 #   mean - mean data from the fits images
+#   threshold - values at or above this are outliers
+#   mask - true where a pixel is an outlier
 #   num - number of outliers
+#   rows - number of outliers in each row
+#   cols - number of outliers in each column
 # RETURN
-#   nothing
+#   num, rows, cols
 ##########
-    
-def outliers(mean):
-    num = 0
-    
-    for i in range(len(mean)):
-        for j in range(len(mean[i])):
-            if mean[i][j] >= 10000:
-                num = num + 1
+
+# pixels of a master dark at or above this value are counted as hot
+OUTLIER_THRESHOLD = 10000
+
+def outliers(mean, threshold=OUTLIER_THRESHOLD):
+    mask = bad_pixel_mask(mean, threshold)
+    num = int(np.count_nonzero(mask))
+    rows = mask.sum(axis=1)
+    cols = mask.sum(axis=0)
 
     print num
 
+    return num, rows, cols
+
+
+##########
+# DESCRIPTION
+#   marks the hot pixels of a master dark
+# PARAMETERS
+#   mean - mean data from the fits images
+#   threshold - values at or above this are outliers
+# RETURN
+#   boolean mask, true where a pixel is hot
+##########
+
+def bad_pixel_mask(mean, threshold=OUTLIER_THRESHOLD):
+    return mean >= threshold
+
 
     
 ##########
@@ -164,21 +348,219 @@ def outliers(mean):
 #   mean - mean data from the images
 #   path2 - where you want the new fits to be created
 #   filename - what you want the new filename to be called
+#   stats - rejection statistics from combine() to record in the header (optional)
+#   mask - bad pixel mask written as a 'BPM' image extension (optional)
+#   keywords - dictionary of extra header keywords (optional)
 #   hdu - puts the mean data into a fits format
 #   newimage - combines path2 and filename
 # RETURN
 #   nothing
 ##########
     
-def master_dark(mean, path2, filename):
+def master_dark(mean, path2, filename, stats=None, mask=None, keywords=None):
 
     hdu = fits.PrimaryHDU(mean)
+    for k, v in (keywords or {}).items():
+        hdu.header[k] = v
+    if stats is not None:
+        hdu.header['COMBINE'] = (stats['method'], 'combine method')
+        hdu.header['NCOMBINE'] = (stats['ncombine'], 'number of frames combined')
+        hdu.header['NREJECT'] = (stats['rejected'], 'pixel values rejected')
+        hdu.header['FREJECT'] = (stats['fraction'], 'fraction of pixel values rejected')
     newimage = os.path.join(path2, filename)
     
     if os.path.exists(newimage):
         os.remove(newimage)
         
+    if mask is not None:
+        hdu.header['NBADPIX'] = (int(np.count_nonzero(mask)), 'pixels flagged in BPM extension')
+        bpm = fits.ImageHDU(mask.astype(np.uint8), name='BPM')
+        hdu = fits.HDUList([hdu, bpm])
+
     hdu.writeto(newimage)
+    forget_listings([newimage])
+    instrument.count('bytes_written', os.path.getsize(newimage))
+
+
+
+##########
+# DESCRIPTION
+#   Builds every master calibration frame for a night in one go. The night is
+#   scanned once and the frames are grouped by type: all biases, darks by
+#   exposure time and flats by filter. The biases are combined first, then
+#   every dark and flat group is combined in parallel across a process pool
+#   with the night's master bias subtracted. Flats are scaled to a median of
+#   one. The masters are written where PipeLineSupport's FindBiasFrame,
+#   FindDarkFrame and FindFlatFrame look for them:
+#       cal_path/<date>/Bias/<date>mbias.fits
+#       cal_path/<date>/Dark/<date>mdark<exposure>.fits
+#       cal_path/<date>/Flat/<filter>/<date>mflat<filter>.fits
+# PARAMETERS
+#   night_path - directory with the night's raw bias, dark and flat frames
+#   cal_path - top of the calibration tree
+#   method - how each group is combined, see combine()
+#   processes - size of the process pool (default: one per cpu)
+#   index - header index to read from (optional)
+#   dtype - type of the combine arithmetic, see combine()
+#   groups - frames grouped by (type, night, exposure or filter)
+#   tasks - one (group, files, output) job per master
+# RETURN
+#   list of master frames written
+##########
+
+# header keywords needed to group raw calibration frames
+MASTER_KEYWORDS = ['IMAGETYP', 'EXPTIME', 'EXPOSURE', 'FILTER', 'DATE-OBS']
+
+@instrument.stage
+def build_masters(night_path, cal_path, method='median', processes=None, index=None, dtype=None):
+    images = sort(sorted(os.listdir(night_path)))
+    if index is not None:
+        records = index.records(images, MASTER_KEYWORDS, night_path)
+    else:
+        records = header_records(images, MASTER_KEYWORDS, night_path)
+
+    groups = calibration_groups(images, records, night_path)
+
+    biases = {}
+    first, second = [], []
+    for key in sorted(groups):
+        output = master_path(cal_path, *key)
+        task = (key, groups[key], output, method, None, dtype)
+        if key[0] == 'bias':
+            biases[key[1]] = output
+            first.append(task)
+        else:
+            second.append(task)
+
+    # darks and flats need their night's master bias, so it is built first
+    second = [t[:4] + (biases.get(t[0][1]),) + t[5:] for t in second]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        written = instrument.pool_map(pool, build_group, first)
+        written = written + instrument.pool_map(pool, build_group, second)
+    finally:
+        pool.close()
+        pool.join()
+
+    # the masters were written by the pool workers; lookups in this process
+    # must not trust listings of cal_path taken before
+    forget_listings(written)
+
+    return written
+
+
+##########
+# DESCRIPTION
+#   groups raw calibration frames by the master they go into: bias frames by
+#   night, darks by night and exposure time, flats by night and filter.
+#   Frames without a valid DATE-OBS, darks without an exposure time and flats
+#   without a filter are skipped with a message, since there is no master
+#   they could go into
+# PARAMETERS
+#   images - list of fits files
+#   records - header records of the images, with the MASTER_KEYWORDS
+#   night_path - directory the images are in
+#   kind - 'bias', 'dark', 'flat' or None for other frames
+#   value - exposure time for darks, filter for flats
+# RETURN
+#   dictionary of (type, night, exposure or filter) -> list of files
+##########
+
+def calibration_groups(images, records, night_path):
+    groups = {}
+    for i, r in zip(images, records):
+        kind = frame_type(r['IMAGETYP'])
+        if kind is None:
+            continue
+        try:
+            night = observation_night(r['DATE-OBS'])
+        except (TypeError, ValueError):
+            print i + ': %s without a valid DATE-OBS, skipped' % kind
+            continue
+        value = None
+        if kind == 'dark':
+            value = r['EXPTIME'] if r['EXPTIME'] is not None else r['EXPOSURE']
+            if value is None:
+                print i + ': dark without EXPTIME or EXPOSURE, skipped'
+                continue
+        elif kind == 'flat':
+            value = r['FILTER']
+            if not value:
+                print i + ': flat without FILTER, skipped'
+                continue
+        groups.setdefault((kind, night, value), []).append(os.path.join(night_path, i))
+    return groups
+
+
+##########
+# DESCRIPTION
+#   builds the path of a master frame in the calibration tree
+# PARAMETERS
+#   cal_path - top of the calibration tree
+#   kind - 'bias', 'dark' or 'flat'
+#   night - YYYYMMDD observing night
+#   value - exposure time for darks, filter for flats
+# RETURN
+#   the path of the master frame
+##########
+
+def master_path(cal_path, kind, night, value):
+    if kind == 'bias':
+        return os.path.join(cal_path, night, 'Bias', night + 'mbias.fits')
+    if kind == 'dark':
+        return os.path.join(cal_path, night, 'Dark', night + 'mdark' + str(value) + '.fits')
+    return os.path.join(cal_path, night, 'Flat', value, night + 'mflat' + value + '.fits')
+
+
+##########
+# DESCRIPTION
+#   combines one group of frames into a master and writes it; runs in a
+#   worker process of build_masters()
+# PARAMETERS
+#   task - (group key, list of files, output path, method, master bias or None,
+#          dtype of the arithmetic or None)
+#   master - the combined frame
+#   stats - rejection statistics of the combine
+# RETURN
+#   the output path
+##########
+
+@instrument.frame(lambda task: task[2])
+def build_group(task):
+    (kind, night, value), files, output, method, bias, dtype = task
+
+    master, stats = combine(files, '', method, dtype=dtype)
+    keywords = {'IMAGETYP': kind.capitalize() + ' Frame'}
+    mask = None
+
+    if bias is not None:
+        with MappedImage(bias) as image:
+            master -= image.data(master.dtype)
+        keywords['BIASSUB'] = (os.path.basename(bias), 'master bias subtracted')
+
+    if kind == 'bias':
+        keywords['EXPTIME'] = 0.0
+    elif kind == 'dark':
+        keywords['EXPTIME'] = value
+        mask = bad_pixel_mask(master)
+    else:
+        keywords['FILTER'] = value
+        master /= np.median(master)
+
+    directory = os.path.dirname(output)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another worker made it first
+            if not os.path.isdir(directory):
+                raise
+
+    master_dark(master, directory, os.path.basename(output), stats, mask, keywords)
+    print '%s: %s of %d frames' % (output, method, len(files))
+
+    return output
 
    
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -3,12 +3,58 @@
 # Supporting routines for UST Observatory data processing pipeline
 #
 ############################################################################
-import pdb, os, sys, datetime, time, pyfits, shutil, tempfile
-from pyraf import iraf
+import pdb, os, sys, datetime, time, pyfits, shutil, tempfile, multiprocessing
+import numpy as np
 from glob import glob
 from pprint import pprint as pp
+from collections import OrderedDict
+from fits_access import prefetch, PREFETCH_DEPTH, to_physical, listed, LISTING_SECONDS
+import instrument
+from provenance import ProvenanceStore
 
-def BiasSubtract(images, cal_path, outbase="_b"):
+# PyRAF is only needed by the 'iraf' calibration backend
+try:
+	from pyraf import iraf
+except ImportError:
+	iraf = None
+
+# Backend used by the calibration stages when none is given: 'iraf' or 'numpy'
+DEFAULT_BACKEND = 'iraf' if iraf is not None else 'numpy'
+
+# Maximum number of headers kept by the process-wide header cache
+HEADER_CACHE_SIZE = 1024
+
+# (absolute path, hdu) -> header, least recently used first
+_header_cache = OrderedDict()
+
+# header_index.HeaderIndex that primary headers are read from (see UseHeaderIndex)
+_header_index = None
+_header_index_pid = None
+
+# Memory budget in bytes for master calibration frames held in memory
+CAL_CACHE_BYTES = 1024**3
+
+# (absolute path, scale) -> read-only float32 array, least recently used first
+_cal_cache = OrderedDict()
+_cal_cache_bytes = 0
+
+# absolute path -> bad pixel mask from the frame's BPM extension (or None)
+_cal_mask_cache = {}
+
+# absolute path -> ((mtime, size) of a calibration frame when it was cached, time checked)
+_cal_cache_stamps = {}
+
+# Memory budget in bytes for one stack of frames calibrated together by CalibrateBatch
+BATCH_BYTES = 256 * 1024**2
+
+# Skip frames whose output was made from the same, unchanged inputs (see OutputUnchanged)
+SKIP_UNCHANGED = True
+
+# (process id, output directory) -> provenance.ProvenanceStore
+_provenance = {}
+
+@instrument.stage
+def BiasSubtract(images, cal_path, outbase="_b", backend=None, workers=1):
 #"""
 # 	Locate and subtract a bias frame from a list of input images#
 #
@@ -18,10 +64,13 @@ def BiasSubtract(images, cal_path, outbase="_b"):
 #
 # OPTIONAL PARAMETERS
 #	outbase - string to append to the end of the filename
+#	backend - 'iraf' (imarith) or 'numpy' (in process).  Default = DEFAULT_BACKEND
+#	workers - number of worker processes, None for one per CPU.  Default = 1
 #
 # RETURNS:
 #	List of bias subtracted images
 #"""
+	backend = backend or DEFAULT_BACKEND
 	
 	# Get a list of bias frames for these images.
 	bias_frames = [FindBiasFrame(i, cal_path) for i in images]	
@@ -31,20 +80,29 @@ def BiasSubtract(images, cal_path, outbase="_b"):
 	out = [i[0] + outbase + '.fits' for i in out]	# Paste the outbase at the end of the filename 
 												# and put the extension back on
 	# run imarith to do the bias subraction	
-	iraf.imarith.unlearn()
-	iraf.imarith.op = '-'
-	iraf.imarith.mode = 'h'
+	if backend == 'iraf':
+		iraf.imarith.unlearn()
+		iraf.imarith.mode = 'h'
 
 	print "\n******************"
 	print "Bias Subtracting: "
 	print "******************"
+	tasks = []
+	sources = []
 	for i in range(len(images)):
-		iraf.imarith.operand1 = images[i]
-		iraf.imarith.operand2 = bias_frames[i]
-		iraf.imarith.result = out[i]
-
 		print images[i] + " - " + bias_frames[i]
-		iraf.imarith()
+
+		if bias_frames[i] != "":
+			source = ([images[i], bias_frames[i]], {'op': '-'})
+			if OutputUnchanged(out[i], *source):
+				continue
+			tasks.append((images[i], '-', bias_frames[i], out[i], backend))
+			sources.append(source)
+
+	RecordProvenance(RunImArithTasks(tasks, workers), sources)
+
+	# The outputs may have overwritten files that are already in the header cache
+	InvalidateHeaderCache(out)
 
     # Make sure that imarith actually created the output files.
     # Filter out any output files that don't exist.
@@ -64,54 +122,83 @@ def BiasSubtract(images, cal_path, outbase="_b"):
 #
 # OPTIONAL PARAMETERS
 #	outbase - string to append to the end of the filename. Default = "_d"
+#	backend - 'iraf' (imarith) or 'numpy' (in process).  Default = DEFAULT_BACKEND
+#	workers - number of worker processes, None for one per CPU.  Default = 1
 #
 # RETURNS:
 #	List of dark subtracted images
 #
 ############################################################################
-def DarkSubtract(images, cal_path, outbase="_d"):
+@instrument.stage
+def DarkSubtract(images, cal_path, outbase="_d", backend=None, workers=1):
+	backend = backend or DEFAULT_BACKEND
 	
 	# Get a list of dark images
 	darks = [FindDarkFrame(i, cal_path) for i in images]
 	out = [os.path.splitext(i)[0]+outbase+'.fits' for i in images]
 
-	iraf.imarith.unlearn() # initial imarith setup
-	iraf.imarith.mode='h'
+	if backend == 'iraf':
+		iraf.imarith.unlearn() # initial imarith setup
+		iraf.imarith.mode='h'
+
+	# imarith needs the scaled darks on disk.  Each (dark, scale) pair is written
+	# once into a private temporary directory, so concurrent runs sharing
+	# cal_path can't clobber each other's scaled darks.
+	scaled_darks = {}
+	tmpdir = None
 
 	print "\n******************"
 	print "Dark Subtracting: "
 	print "******************"
-	for i in range(len(images)):
+	try:
+		tasks = []
+		sources = []
+		for i in range(len(images)):
 
-		iexp_time = GetHeaderKeyword(images[i], 'exptime')
-		dexp_time = GetHeaderKeyword(darks[i], 'exptime')
+			iexp_time = GetHeaderKeyword(images[i], 'exptime')
+			dexp_time = GetHeaderKeyword(darks[i], 'exptime')
 
-		# If exposure times don't match, scale the dark and fill in the operand2 field
-		if iexp_time != dexp_time:
-			iraf.imarith.operand1 = darks[i]
-			iraf.imarith.operand2 = iexp_time/dexp_time	
-			iraf.imarith.op = '*'
+			print images[i] + ' - ' + darks[i]
 
-			# Create temporary dark filename
-			tdark = os.path.join(os.path.dirname(darks[i]),'tmpdark')
-			iraf.imarith.result = tdark
-			iraf.imarith()
-		
-			iraf.imarith.operand2 = tdark
+			if darks[i] == "":
+				print "No dark found for " + images[i]
+				continue
 
-		else: 
-			iraf.imarith.operand2 = darks[i]
+			# The scaled dark is computed once and kept in the calibration cache
+			scale = float(iexp_time)/dexp_time
+
+			source = ([images[i], darks[i]], {'op': '-', 'scale': scale})
+			if OutputUnchanged(out[i], *source):
+				continue
+			sources.append(source)
+
+			if backend == 'numpy':
+				tasks.append((images[i], '-', darks[i], out[i], backend, scale, None, True))
+				continue
+
+			# If exposure times don't match, subtract the scaled dark instead
+			dark = darks[i]
+			if iexp_time != dexp_time:
+				key = (darks[i], scale)
+				if key not in scaled_darks:
+					if tmpdir is None:
+						tmpdir = tempfile.mkdtemp(prefix='tmpdark')
+					scaled_darks[key] = os.path.join(tmpdir, 'tmpdark%d.fits' % len(scaled_darks))
+					WriteImage(scaled_darks[key], GetCalibrationFrame(darks[i], scale), GetHeader(darks[i]))
+
+				dark = scaled_darks[key]
+
+			tasks.append((images[i], '-', dark, out[i], backend))
 
 		# Perform the dark subtraction
-		iraf.imarith.operand1 = images[i]
-		iraf.imarith.op = '-'
-		iraf.imarith.result = out[i]
-		print iraf.imarith.operand1 + ' - ' + iraf.imarith.operand2
-		iraf.imarith()
+		RecordProvenance(RunImArithTasks(tasks, workers), sources)
+
+	finally:
+		# Remove the scaled darks
+		if tmpdir is not None:
+			shutil.rmtree(tmpdir, ignore_errors=True)
 
-		# Remove the scaled dark
-		if iexp_time != dexp_time:
-			os.remove(tdark+'.fits')
+	InvalidateHeaderCache(out)
 
 	# Make sure out files actually exist 
 	out = filter(os.path.exists, out)
@@ -130,14 +217,16 @@ def DarkSubtract(images, cal_path, outbase="_d"):
 #
 # OPTIONAL PARAMETERS
 #	outbase - string to append to the end of the filename. Default = "_f"
+#	backend - 'iraf' (imarith) or 'numpy' (in process).  Default = DEFAULT_BACKEND
+#	workers - number of worker processes, None for one per CPU.  Default = 1
 #
 # RETURNS:
 #	List of dark subtracted images
 #
 ############################################################################
-def FlatField(images, cal_path, outbase='_f'):
-	
-    
+@instrument.stage
+def FlatField(images, cal_path, outbase='_f', backend=None, workers=1):
+	backend = backend or DEFAULT_BACKEND
 
 	# Get a list of flat frames
 	flats = [FindFlatFrame(i, cal_path) for i in images]
@@ -148,33 +237,401 @@ def FlatField(images, cal_path, outbase='_f'):
 	Ret = []		# Empty list to hold return
 
 	#setup imarith basics
-	iraf.imarith.unlearn()
-	iraf.imarith.op = '/'
-	iraf.imarith.mode = 'h'
+	if backend == 'iraf':
+		iraf.imarith.unlearn()
+		iraf.imarith.mode = 'h'
 
 	print "\n******************"
 	print "Flat Fielding: "
 	print "******************"
+	tasks = []
+	sources = []
 	for i in range(len(images)):
 		
 		if flats[i] != "":
-		
-			iraf.imarith.operand1 = images[i]
-			iraf.imarith.operand2 = flats[i]
-			iraf.imarith.result = out[i]
-			iraf.imarith()
-
-
 			print images[i] + ' / ' + flats[i]			
 			Ret.append(out[i])
+
+			source = ([images[i], flats[i]], {'op': '/'})
+			if OutputUnchanged(out[i], *source):
+				continue
+			tasks.append((images[i], '/', flats[i], out[i], backend))
+			sources.append(source)
 		
 		else:
 			print "No flat found for " + images[i]
 
+	RecordProvenance(RunImArithTasks(tasks, workers), sources)
+
+	InvalidateHeaderCache(Ret)
 		
 	return Ret
 	
 
+############################################################################
+# NAME: Calibrate
+#
+# DESCRIPTION:
+# 	Fused bias -> dark -> flat -> exposure normalization.  Each raw frame is
+#	read once, every requested correction is applied in memory and only the
+#	final product is written.  The output is named as if the separate stages
+#	had been chained, e.g. image_b_d_f_n.fits.
+#
+# PARAMETERS:
+# 	images - list of images to process
+#	cal_path - path to calibration data
+#
+# OPTIONAL PARAMETERS
+#	bias, dark, flat, normalize - which corrections to apply.  Default = all
+#	keep_intermediates - also write the _b, _b_d, ... frames.  Default = False
+#	workers - number of worker processes, None for one per CPU.  Default = 1
+#	batch - calibrate frames sharing their calibration frames as 3-D stacks
+#		(see CalibrateBatch).  Ignored with keep_intermediates.  Default = False
+#
+# RETURNS:
+#	List of calibrated images
+#
+############################################################################
+@instrument.stage
+def Calibrate(images, cal_path, bias=True, dark=True, flat=True, normalize=True,
+		keep_intermediates=False, workers=1, batch=False):
+
+	if batch and not keep_intermediates:
+		return CalibrateBatch(images, cal_path, bias, dark, flat, normalize, workers)
+
+	print "\n******************"
+	print "Calibrating: "
+	print "******************"
+
+	# Nothing to do; never write over the raw frames
+	if not (bias or dark or flat or normalize):
+		return list(images)
+
+	results = {}
+	tasks = []
+	sources = []
+	for image in images:
+		frames = CalibrationFrames(image, cal_path, bias, dark, flat)
+		if frames is None:
+			continue
+		source = ([image] + [f for f in frames if f is not None], {})
+		out = CalibratedName(image, bias, dark, flat, normalize)
+		if not keep_intermediates and OutputUnchanged(out, *source):
+			results[image] = out
+			continue
+		tasks.append((image, cal_path, bias, dark, flat, normalize, keep_intermediates))
+		sources.append(source)
+
+	written = RunParallel(CalibrateImageTask, tasks, workers)
+	RecordProvenance(written, sources)
+	results.update(zip([t[0] for t in tasks], written))
+
+	# Workers have their own header caches; drop any stale copies in this one
+	InvalidateHeaderCache(written)
+
+	return [results[image] for image in images if results.get(image, "") != ""]
+
+############################################################################
+# NAME: CalibrateImageTask
+#
+# DESCRIPTION:
+# 	CalibrateImage with its arguments packed in one tuple, for RunParallel.
+#
+############################################################################
+def CalibrateImageTask(task):
+	return CalibrateImage(*task)
+
+############################################################################
+# NAME: CalibrateImage
+#
+# DESCRIPTION:
+# 	Apply the fused calibration to a single image.  See Calibrate.
+#
+# PARAMETERS:
+# 	image - image to process
+#	cal_path - path to calibration data
+#	bias, dark, flat, normalize - which corrections to apply
+#
+# OPTIONAL PARAMETERS
+#	keep_intermediates - also write the intermediate frames.  Default = False
+#
+# RETURNS:
+#	The calibrated image name
+#	The null string if a calibration frame is missing or the image can't be read
+#
+############################################################################
+@instrument.frame(lambda image, *args, **kwargs: image)
+def CalibrateImage(image, cal_path, bias, dark, flat, normalize, keep_intermediates=False):
+
+	# Nothing to do; never write over the raw frame
+	if not (bias or dark or flat or normalize):
+		return image
+
+	try:
+		data, header = ReadImage(image)
+	except IOError, e:
+		print "CalibrateImage: "
+		print e
+		return ""
+
+	iexp_time = GetHeaderKeyword(image, 'exptime')
+	name = os.path.splitext(image)[0]
+	written = []
+	mask = None			# Hot pixels of the dark, carried into the outputs
+
+	if bias:
+		bias_frame = FindBiasFrame(image, cal_path)
+		if bias_frame == "":
+			return ""
+		data -= GetCalibrationFrame(bias_frame)
+		name = name + '_b'
+		if keep_intermediates:
+			WriteImage(name + '.fits', data, header)
+			written.append(name + '.fits')
+
+	if dark:
+		dark_frame = FindDarkFrame(image, cal_path)
+		if dark_frame == "":
+			print "No dark found for " + image
+			return ""
+		dexp_time = GetHeaderKeyword(dark_frame, 'exptime')
+		data -= GetCalibrationFrame(dark_frame, float(iexp_time)/dexp_time)
+		mask = GetCalibrationMask(dark_frame)
+		name = name + '_d'
+		if keep_intermediates:
+			WriteImage(name + '.fits', data, header, mask=mask)
+			written.append(name + '.fits')
+
+	if flat:
+		flat_frame = FindFlatFrame(image, cal_path)
+		if flat_frame == "":
+			print "No flat found for " + image
+			return ""
+		data = SafeDivide(data, GetCalibrationFrame(flat_frame))
+		name = name + '_f'
+		if keep_intermediates:
+			WriteImage(name + '.fits', data, header, mask=mask)
+			written.append(name + '.fits')
+
+	keywords = None
+	if normalize:
+		data = SafeDivide(data, iexp_time)
+		name = name + '_n'
+		keywords = {'exptime': 1}
+
+	out = name + '.fits'
+	if out not in written:
+		WriteImage(out, data, header, keywords, mask)
+		written.append(out)
+	print image + " -> " + out
+
+	InvalidateHeaderCache(written)
+
+	return out
+
+############################################################################
+# NAME: CalibrateBatch
+#
+# DESCRIPTION:
+# 	Batched form of Calibrate for long series of short exposures.  Images
+#	that share their bias, dark, flat and dimensions are read into one 3-D
+#	float32 array (up to BATCH_BYTES at a time) and every correction is a
+#	single broadcast operation over the stack: bias subtraction, dark
+#	subtraction scaled by iexp_time/dexp_time per frame, flat division and
+#	exposure normalization.  Each frame is still written to its own file,
+#	named as Calibrate names it.
+#
+# PARAMETERS:
+# 	images - list of images to process
+#	cal_path - path to calibration data
+#
+# OPTIONAL PARAMETERS
+#	bias, dark, flat, normalize - which corrections to apply.  Default = all
+#	workers - number of worker processes, None for one per CPU.  Default = 1
+#
+# RETURNS:
+#	List of calibrated images
+#
+############################################################################
+@instrument.stage
+def CalibrateBatch(images, cal_path, bias=True, dark=True, flat=True, normalize=True,
+		workers=1):
+
+	print "\n******************"
+	print "Calibrating in batches: "
+	print "******************"
+
+	# Nothing to do; never write over the raw frames
+	if not (bias or dark or flat or normalize):
+		return list(images)
+
+	results = {}
+	sources = {}
+	groups = OrderedDict()
+	for image in images:
+		key = CalibrationFrames(image, cal_path, bias, dark, flat)
+		if key is None:
+			continue
+		sources[image] = ([image] + [f for f in key if f is not None], {})
+		out = CalibratedName(image, bias, dark, flat, normalize)
+		if OutputUnchanged(out, *sources[image]):
+			results[image] = out
+			continue
+		try:
+			header = GetHeader(image)
+			shape = (header['NAXIS2'], header['NAXIS1'])
+		except (IOError, KeyError), e:
+			print "CalibrateBatch: "
+			print e
+			continue
+		groups.setdefault(key + (shape,), []).append(image)
+
+	tasks = []
+	for key, group in groups.items():
+		n = max(1, BATCH_BYTES // (key[3][0] * key[3][1] * 4))
+		for i in range(0, len(group), n):
+			tasks.append((group[i:i + n], key[:3], normalize))
+
+	for task, written in zip(tasks, RunParallel(CalibrateBatchTask, tasks, workers)):
+		RecordProvenance(written, [sources[image] for image in task[0]])
+		results.update(zip(task[0], written))
+
+	# In the order the images were given
+	out = [results[image] for image in images if results.get(image, "") != ""]
+	InvalidateHeaderCache(out)
+
+	return out
+
+############################################################################
+# NAME: CalibratedName
+#
+# DESCRIPTION:
+# 	The name Calibrate gives the product of an image, e.g. image_b_d_f_n.fits.
+#
+# PARAMETERS:
+# 	image - image to process
+#	bias, dark, flat, normalize - which corrections are applied
+#
+# RETURNS:
+#	The calibrated image name
+#
+############################################################################
+def CalibratedName(image, bias, dark, flat, normalize):
+
+	suffix = ''.join(s for s, on in (('_b', bias), ('_d', dark), ('_f', flat), ('_n', normalize)) if on)
+	return os.path.splitext(image)[0] + suffix + '.fits'
+
+############################################################################
+# NAME: CalibrationFrames
+#
+# DESCRIPTION:
+# 	Find the calibration frames CalibrateBatch groups an image by.
+#
+# PARAMETERS:
+# 	image - image to process
+#	cal_path - path to calibration data
+#	bias, dark, flat - which corrections are applied
+#
+# RETURNS:
+#	(bias frame, dark frame, flat frame), None for corrections not applied
+#	None if a calibration frame is missing.
+#
+############################################################################
+def CalibrationFrames(image, cal_path, bias, dark, flat):
+
+	frames = [None, None, None]
+
+	if bias:
+		frames[0] = FindBiasFrame(image, cal_path)
+		if frames[0] == "":
+			return None
+
+	if dark:
+		frames[1] = FindDarkFrame(image, cal_path)
+		if frames[1] == "":
+			print "No dark found for " + image
+			return None
+
+	if flat:
+		frames[2] = FindFlatFrame(image, cal_path)
+		if frames[2] == "":
+			print "No flat found for " + image
+			return None
+
+	return tuple(frames)
+
+############################################################################
+# NAME: CalibrateBatchTask
+#
+# DESCRIPTION:
+# 	Calibrate one stack of images that share their calibration frames and
+#	dimensions.  See CalibrateBatch.
+#
+# PARAMETERS:
+#	task - (images, (bias frame, dark frame, flat frame), normalize)
+#
+# RETURNS:
+#	List of the calibrated image names in the same order as the images
+#	The null string for an image that can't be read
+#
+############################################################################
+@instrument.frame(lambda task: '%s (%d frames)' % (task[0][0], len(task[0])))
+def CalibrateBatchTask(task):
+
+	images, (bias_frame, dark_frame, flat_frame), normalize = task
+
+	names, headers = [], []
+	stack = None
+	for (image,), pixels in prefetch([(image,) for image in images], PrefetchOperand):
+		if isinstance(pixels, basestring):		# Unreadable
+			print "CalibrateBatch: can't read " + image
+			continue
+		data, header = pixels[:2]
+		if stack is None:
+			stack = np.empty((len(images),) + data.shape, np.float32)
+		stack[len(names)] = data
+		names.append(image)
+		headers.append(header)
+
+	if not names:
+		return [""] * len(images)
+	stack = stack[:len(names)]
+
+	iexp_time = np.array([GetHeaderKeyword(image, 'exptime') for image in names], np.float32)
+	suffix = ''
+	mask = None
+
+	if bias_frame is not None:
+		stack -= GetCalibrationFrame(bias_frame)
+		suffix = suffix + '_b'
+
+	if dark_frame is not None:
+		dexp_time = GetHeaderKeyword(dark_frame, 'exptime')
+		scale = np.array([float(t)/dexp_time for t in iexp_time], np.float32)
+		stack -= scale[:, None, None] * GetCalibrationFrame(dark_frame)
+		mask = GetCalibrationMask(dark_frame)
+		suffix = suffix + '_d'
+
+	if flat_frame is not None:
+		flat_data = GetCalibrationFrame(flat_frame)
+		np.divide(stack, flat_data, out=stack, where=(flat_data != 0))
+		stack[:, flat_data == 0] = 0
+		suffix = suffix + '_f'
+
+	keywords = None
+	if normalize:
+		stack = SafeDivide(stack, iexp_time[:, None, None])
+		suffix = suffix + '_n'
+		keywords = {'exptime': 1}
+
+	written = {}
+	for i, image in enumerate(names):
+		written[image] = os.path.splitext(image)[0] + suffix + '.fits'
+		WriteImage(written[image], stack[i], headers[i], keywords, mask)
+		print image + " -> " + written[image]
+
+	return [written.get(image, "") for image in images]
+	
 ############################################################################
 # NAME: FindBiasFrame
 #
@@ -204,9 +661,9 @@ def FindBiasFrame(image, cal_path):
 	stand_bias_path = os.path.join(cal_path,'Standard','Bias','mbias.fits')
             
 	# Look for a master bias frame from this observing night
-	if os.path.exists(bias_path):
+	if CalFrameExists(bias_path, cal_path):
 		return bias_path
-	elif os.path.exists(stand_bias_path):
+	elif CalFrameExists(stand_bias_path, cal_path):
 		return stand_bias_path
 	else:
 		print "No bias frame found."
@@ -247,13 +704,13 @@ def FindDarkFrame(image, cal_path):
 	scaled_standard_path = os.path.join(cal_path,'Standard','Dark','mdark.fits')
 
 	# Search for an appropriate dark frame
-	if os.path.exists(unscaled_date_path):
+	if CalFrameExists(unscaled_date_path, cal_path):
 		return unscaled_date_path	
-	elif os.path.exists(unscaled_standard_path):
+	elif CalFrameExists(unscaled_standard_path, cal_path):
 		return unscaled_standard_path	
-	elif os.path.exists(scaled_date_path):
+	elif CalFrameExists(scaled_date_path, cal_path):
 		return scaled_date_path	
-	elif os.path.exists(scaled_standard_path):
+	elif CalFrameExists(scaled_standard_path, cal_path):
 		return scaled_standard_path	
 	else: 
 		return ""
@@ -286,14 +743,42 @@ def FindFlatFrame(image, cal_path):
 	standard_path = os.path.join(cal_path,'Standard','Flat',ifilter,'mflat'+ifilter+'.fits')
 
 	# Search for an appropriate dark frame
-	if os.path.exists(date_path):
+	if CalFrameExists(date_path, cal_path):
 		return date_path	
-	elif os.path.exists(standard_path):
+	elif CalFrameExists(standard_path, cal_path):
 		return standard_path	
 	else: 
 		return ""
 
 
+############################################################################
+# NAME: CalFrameExists
+#
+# DESCRIPTION:
+# 	os.path.exists for calibration frames, answered from directory listings
+#	of the calibration tree kept in memory (see fits_access.listed), so the
+#	candidate paths tried by FindBiasFrame, FindDarkFrame and FindFlatFrame
+#	cost no file system calls for most images.  A directory is checked
+#	again at most every fits_access.LISTING_SECONDS; masters written by
+#	MasterDark_BiasSub_Test7 are seen at once in the process that wrote
+#	them.  Paths outside cal_path are looked up on disk.
+#
+# PARAMETERS:
+#	frame - path of the candidate calibration frame
+#	cal_path - Path to calibration data
+#
+# RETURNS:
+#	True if the frame is in the calibration tree
+#
+############################################################################
+def CalFrameExists(frame, cal_path):
+
+	top = os.path.abspath(cal_path) + os.sep
+	if not os.path.abspath(frame).startswith(top):
+		return os.path.exists(frame)
+
+	return listed(frame)
+
 ############################################################################
 # NAME: ExpNormalize
 #
@@ -308,12 +793,16 @@ def FindFlatFrame(image, cal_path):
 #
 # OPTIONAL PARAMETERS
 #	outbase - string to append to the end of the filename
+#	backend - 'iraf' (imarith/hedit) or 'numpy' (in process).  Default = DEFAULT_BACKEND
+#	workers - number of worker processes, None for one per CPU.  Default = 1
 #
 # RETURNS:
 #	List of bias subtracted images
 #
 ############################################################################
-def ExpNormalize(images, outbase="_n"):
+@instrument.stage
+def ExpNormalize(images, outbase="_n", backend=None, workers=1):
+	backend = backend or DEFAULT_BACKEND
 			
 	# Build the list of output image names
 	out = [os.path.splitext(i) for i in images]	# Split off the extension
@@ -321,34 +810,496 @@ def ExpNormalize(images, outbase="_n"):
 												# and put the extension back on
 	# Get a list of exposure times.
 	exp_times = [GetHeaderKeyword(i, 'exptime') for i in images]
-	exp_times = [str(e) for e in exp_times]	
 	
-	# run imarith to do the normalization
-	iraf.imarith.unlearn()
-	iraf.imarith.op = '/'
-	iraf.imarith.mode = 'h'
+	# run imarith to do the normalization and update the exptime keyword
+	if backend == 'iraf':
+		iraf.imarith.unlearn()
+		iraf.imarith.mode = 'h'
 
+	tasks = []
+	sources = []
 	for i in range(len(images)):
-		iraf.imarith.operand1 = images[i]
-		iraf.imarith.operand2 = exp_times[i]
-		iraf.imarith.result = out[i]
-	
-		iraf.imarith()
+		source = ([images[i]], {'op': '/', 'operand': exp_times[i]})
+		if OutputUnchanged(out[i], *source):
+			continue
+		tasks.append((images[i], '/', exp_times[i], out[i], backend, 1.0, {'exptime': 1}))
+		sources.append(source)
+
+	RecordProvenance(RunImArithTasks(tasks, workers), sources)
+
+	# exptime was rewritten in the output headers
+	InvalidateHeaderCache(out)
+
+	return out
+
 
-		# update the exptime keyword		
+############################################################################
+# NAME: ImArithTask
+#
+# DESCRIPTION:
+# 	Run one image operation of a calibration stage with either backend.
+#	Called directly or in a worker process by RunParallel, so it sets every
+#	imarith parameter it relies on.
+#
+# PARAMETERS:
+# 	task - tuple of
+#		operand1 - input image
+#		op - one of '+', '-', '*', '/'
+#		operand2 - calibration frame or number
+#		result - output image name
+#		backend - 'iraf' or 'numpy'
+#	and optionally
+#		scale - numpy backend: factor applied to the calibration frame.  Default = 1.0
+#		keywords - dictionary of header keywords to set in the result
+#		use_mask - numpy backend: carry the frame's bad pixel mask.  Default = False
+#
+# RETURNS:
+#	The output image name
+#	The null string if the numpy backend can't read an operand
+#
+############################################################################
+@instrument.frame(lambda task: task[3])
+def ImArithTask(task):
+
+	operand1, op, operand2, result, backend = task[:5]
+	defaults = (1.0, None, False)
+	scale, keywords, use_mask = task[5:] + defaults[len(task) - 5:]
+
+	if backend == 'numpy':
+		mask = None
+		if isinstance(operand2, basestring):
+			if use_mask:
+				mask = GetCalibrationMask(operand2)
+			operand2 = GetCalibrationFrame(operand2, scale)
+		if not ImArith(operand1, op, operand2, result, keywords, mask):
+			return ""
+		return result
+
+	iraf.imarith.operand1 = operand1
+	iraf.imarith.op = op
+	iraf.imarith.operand2 = str(operand2)
+	iraf.imarith.result = result
+	iraf.imarith()
+
+	for k, v in (keywords or {}).items():
 		iraf.hedit.unlearn()
 		iraf.hedit.verify='no'
 		iraf.hedit.show='yes'
 		iraf.hedit.update='yes'
-		iraf.hedit.images=out[i]
-		iraf.hedit.fields='exptime'
-		iraf.hedit.value=1
+		iraf.hedit.images=result
+		iraf.hedit.fields=k
+		iraf.hedit.value=v
 		iraf.hedit.mode='h'
 
 		iraf.hedit(Stdout=1)
 
+	return result
+
+############################################################################
+# NAME: RunImArithTasks
+#
+# DESCRIPTION:
+# 	Run a stage's ImArithTask list.  On a pool when workers allows it;
+#	otherwise, for the numpy backend, the next input images are read in a
+#	background thread while the current one is processed, so disk reads
+#	overlap with the arithmetic.
+#
+# PARAMETERS:
+#	tasks - list of ImArithTask tuples
+#
+# OPTIONAL PARAMETERS:
+#	workers - number of worker processes, None for one per CPU.  Default = 1
+#	depth - how many input images may be read ahead.  Default = PREFETCH_DEPTH
+#
+# RETURNS:
+#	List of output image names in the same order as tasks
+#
+############################################################################
+def RunImArithTasks(tasks, workers=1, depth=PREFETCH_DEPTH):
+
+	if workers != 1 or depth < 1 or not tasks or tasks[0][4] != 'numpy':
+		return RunParallel(ImArithTask, tasks, workers)
+
+	out = []
+	for task, pixels in prefetch(tasks, PrefetchOperand, depth):
+		out.append(ImArithTask((pixels,) + task[1:]))
+
 	return out
 
+############################################################################
+# NAME: PrefetchOperand
+#
+# DESCRIPTION:
+# 	Read the input image of an ImArithTask ahead of time.
+#
+# PARAMETERS:
+#	task - ImArithTask tuple
+#
+# RETURNS:
+#	(data, header, mask) of the input image.
+#	The image name if it can't be read, so ImArith reports the error.
+#
+############################################################################
+def PrefetchOperand(task):
+
+	try:
+		return ReadImage(task[0], mask=True)
+	except IOError:
+		return task[0]
+
+############################################################################
+# NAME: RunParallel
+#
+# DESCRIPTION:
+# 	Apply func to every task, in order, spread over a pool of worker
+#	processes.  Runs in this process when workers is 1 or there is only one
+#	task.  Each worker has its own IRAF parameter state and caches.
+#
+# PARAMETERS:
+# 	func - module level function taking one task
+#	tasks - list of tasks
+#
+# OPTIONAL PARAMETERS:
+#	workers - number of worker processes, None for one per CPU.  Default = 1
+#
+# RETURNS:
+#	List of func results in the same order as tasks
+#
+############################################################################
+def RunParallel(func, tasks, workers=1):
+
+	if workers == 1 or len(tasks) < 2:
+		return [func(t) for t in tasks]
+
+	pool = multiprocessing.Pool(workers)
+	try:
+		return instrument.pool_map(pool, func, tasks, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+
+############################################################################
+# NAME: ReadImage
+#
+# DESCRIPTION:
+# 	Read the pixel data and header of an image for the numpy backend.
+#	The stored pixels are memory mapped and converted to physical values
+#	(BZERO/BSCALE applied, BLANK pixels set to NaN) in a single pass straight
+#	into the requested type, so a 16-bit frame never goes through a 64-bit
+#	copy.  The default is 32-bit floats, the same pixel type imarith produces.
+#
+# PARAMETERS:
+# 	image - image to read
+#
+# OPTIONAL PARAMETERS:
+#	hdu - The header data unit.  Default is 0 (first one).
+#	dtype - pixel type of the returned data.  Default = np.float32
+#	mask - also return the image's bad pixel mask ('BPM' extension).  Default = False
+#
+# RETURNS:
+#	(data, header), or (data, header, mask) with mask; mask is None if the
+#	image has no BPM extension
+#
+############################################################################
+def ReadImage(image, hdu=0, dtype=np.float32, mask=False):
+
+	hdulist = pyfits.open(image, memmap=True, do_not_scale_image_data=True)
+	instrument.count('files_opened')
+	try:
+		header = hdulist[hdu].header.copy()
+		blank = header.get('BLANK') if header.get('BITPIX', -32) > 0 else None
+		data = to_physical(hdulist[hdu].data, header.get('BSCALE', 1),
+				header.get('BZERO', 0), dtype, blank)
+		instrument.count('bytes_read', hdulist[hdu].data.nbytes)
+		if mask:
+			try:
+				bpm = hdulist['BPM'].data != 0
+			except KeyError:
+				bpm = None
+	finally:
+		hdulist.close()
+	if mask:
+		return data, header, bpm
+	return data, header
+
+############################################################################
+# NAME: GetCalibrationFrame
+#
+# DESCRIPTION:
+# 	Return the pixels of a master bias/dark/flat through the process-wide
+#	calibration cache, so each master is read from disk once per night (and
+#	again if it is rewritten, see CheckCalibrationCache).
+#	Scaled variants (e.g. a dark scaled by iexp_time/dexp_time) are cached
+#	alongside the unscaled frame.  The least recently used arrays are dropped
+#	once CAL_CACHE_BYTES is exceeded.
+#
+# PARAMETERS:
+# 	frame - calibration image
+#
+# OPTIONAL PARAMETERS:
+#	scale - factor to multiply the frame by.  Default = 1.0
+#
+# RETURNS:
+#	A read-only float32 array.  Raises IOError if the frame can't be read.
+#
+############################################################################
+def GetCalibrationFrame(frame, scale=1.0):
+	global _cal_cache_bytes
+
+	key = (os.path.abspath(frame), float(scale))
+	CheckCalibrationCache(key[0])
+
+	try:
+		data = _cal_cache.pop(key)			# Hit: re-inserted as most recent below
+		_cal_cache[key] = data
+		instrument.cache('calibration_cache', True)
+		return data
+	except KeyError:
+		instrument.cache('calibration_cache', False)
+
+	if key[1] == 1.0:
+		data = ReadImage(frame)[0]
+	else:
+		data = GetCalibrationFrame(frame) * np.float32(key[1])
+	data.flags.writeable = False
+
+	_cal_cache[key] = data
+	_cal_cache_bytes += data.nbytes
+
+	# Evict, but always keep the frame that was just loaded
+	while _cal_cache_bytes > CAL_CACHE_BYTES and len(_cal_cache) > 1:
+		_cal_cache_bytes -= _cal_cache.popitem(last=False)[1].nbytes
+
+	return data
+
+############################################################################
+# NAME: InvalidateCalibrationCache
+#
+# DESCRIPTION:
+# 	Drop cached calibration frames (their scaled variants and masks), e.g. after a
+#	new master has been written.
+#
+# OPTIONAL PARAMETERS:
+#	frames - a frame or list of frames to forget.  Default clears the cache.
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def InvalidateCalibrationCache(frames=None):
+	global _cal_cache_bytes
+
+	if frames is None:
+		_cal_cache.clear()
+		_cal_mask_cache.clear()
+		_cal_cache_stamps.clear()
+		_cal_cache_bytes = 0
+		return
+
+	if isinstance(frames, basestring):
+		frames = [frames]
+
+	paths = set(os.path.abspath(f) for f in frames)
+	for key in [k for k in _cal_cache if k[0] in paths]:
+		_cal_cache_bytes -= _cal_cache.pop(key).nbytes
+	for key in paths:
+		_cal_mask_cache.pop(key, None)
+		_cal_cache_stamps.pop(key, None)
+
+############################################################################
+# NAME: CheckCalibrationCache
+#
+# DESCRIPTION:
+# 	Drop the cached pixels and mask of a calibration frame if the file was
+#	rewritten (or removed) since they were cached, e.g. a master rebuilt
+#	while a long running process such as live_ingest is using it.  Like the
+#	calibration tree listings, a frame is checked on disk at most every
+#	fits_access.LISTING_SECONDS.
+#
+# PARAMETERS:
+# 	path - absolute path of the calibration frame
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def CheckCalibrationCache(path):
+
+	now = time.time()
+	entry = _cal_cache_stamps.get(path)
+	if entry is not None and now - entry[1] < LISTING_SECONDS:
+		return
+
+	try:
+		st = os.stat(path)
+		stamp = (st.st_mtime, st.st_size)
+	except OSError:
+		stamp = None
+
+	if entry is not None and entry[0] != stamp:
+		InvalidateCalibrationCache(path)
+	_cal_cache_stamps[path] = (stamp, now)
+
+############################################################################
+# NAME: GetCalibrationMask
+#
+# DESCRIPTION:
+# 	Return the bad pixel mask stored with a master frame as its 'BPM' image
+#	extension (written by MasterDark_BiasSub_Test7.master_dark), cached like
+#	the frame itself.
+#
+# PARAMETERS:
+# 	frame - calibration image
+#
+# RETURNS:
+#	A read-only boolean array, True at bad pixels.
+#	None if the frame has no BPM extension.
+#
+############################################################################
+def GetCalibrationMask(frame):
+
+	key = os.path.abspath(frame)
+	CheckCalibrationCache(key)
+	instrument.cache('calibration_mask_cache', key in _cal_mask_cache)
+	if key not in _cal_mask_cache:
+		instrument.count('files_opened')
+		try:
+			mask = pyfits.getdata(frame, 'BPM') != 0
+			mask.flags.writeable = False
+		except KeyError:
+			mask = None
+		_cal_mask_cache[key] = mask
+
+	return _cal_mask_cache[key]
+
+############################################################################
+# NAME: ImArith
+#
+# DESCRIPTION:
+# 	In-process equivalent of iraf.imarith for the numpy backend.
+#	The result takes the header of operand1, and its bad pixel mask if it
+#	has one, so a dark's BPM stays with the frame through the flat and
+#	normalization steps.  Division by zero gives zero, as imarith does with
+#	its default divzero.
+#
+# PARAMETERS:
+# 	operand1 - image name, array or (data, header[, mask]) already read by ReadImage
+#	op - one of '+', '-', '*', '/'
+#	operand2 - image name, array or number
+#	result - output image name
+#
+# OPTIONAL PARAMETERS:
+#	keywords - dictionary of header keywords to set in the result
+#	mask - bad pixel mask to store with the result (see WriteImage), added
+#		to the mask of operand1
+#
+# RETURNS:
+#	True on success.
+#	False if an operand can't be read (no output is written).
+#
+############################################################################
+def ImArith(operand1, op, operand2, result, keywords=None, mask=None):
+
+	try:
+		carried = None		# Bad pixel mask of the input, kept in the result
+		if isinstance(operand1, basestring):
+			data, header, carried = ReadImage(operand1, mask=True)
+		elif isinstance(operand1, tuple):
+			data, header, carried = (operand1 + (None,))[:3]
+		else:
+			data, header = np.asarray(operand1, dtype=np.float32), pyfits.Header()
+
+		# pixels read here are ours to overwrite; a caller's array is not
+		out = data if not isinstance(operand1, np.ndarray) and data.flags.writeable else None
+
+		if isinstance(operand2, basestring):
+			operand2 = ReadImage(operand2)[0]
+	except IOError, e:
+		print "ImArith: "
+		print e
+		return False
+
+	if op == '+':
+		data = np.add(data, operand2, out=out)
+	elif op == '-':
+		data = np.subtract(data, operand2, out=out)
+	elif op == '*':
+		data = np.multiply(data, operand2, out=out)
+	elif op == '/':
+		data = SafeDivide(data, operand2)
+	else:
+		raise ValueError("ImArith: unknown operator " + op)
+
+	if carried is not None:
+		mask = carried if mask is None else mask | carried
+
+	WriteImage(result, data.astype(np.float32, copy=False), header, keywords, mask)
+	return True
+
+############################################################################
+# NAME: SafeDivide
+#
+# DESCRIPTION:
+# 	Divide two arrays (or an array by a number) in 32-bit floats, giving
+#	zero wherever the divisor is zero.
+#
+# PARAMETERS:
+# 	a - dividend
+#	b - divisor
+#
+# RETURNS:
+#	The quotient as a new float32 array.
+#
+############################################################################
+def SafeDivide(a, b):
+
+	b = np.asarray(b, dtype=np.float32)
+	out = np.zeros(np.broadcast(a, b).shape, np.float32)
+	return np.divide(a, b, out=out, where=(b != 0))
+
+############################################################################
+# NAME: WriteImage
+#
+# DESCRIPTION:
+# 	Write an array to a fits file, replacing any existing file.
+#
+# PARAMETERS:
+# 	image - output image name
+#	data - pixel array
+#	header - header to write with the data
+#
+# OPTIONAL PARAMETERS:
+#	keywords - dictionary of header keywords to set before writing
+#	mask - bad pixel mask, written as a 'BPM' image extension
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def WriteImage(image, data, header, keywords=None, mask=None):
+
+	header = header.copy()
+	for k in ('bzero', 'bscale', 'blank'):	# The data is written unscaled
+		if k in header:
+			del header[k]
+	for k, v in (keywords or {}).items():
+		header[k] = v
+
+	# pyfits byteswaps in place while writing, so cached frames need a copy
+	if not data.flags.writeable:
+		data = data.copy()
+
+	if mask is None:
+		pyfits.writeto(image, data, header, clobber=True)
+	else:
+		hdus = [pyfits.PrimaryHDU(data, header), pyfits.ImageHDU(mask.astype(np.uint8), name='BPM')]
+		pyfits.HDUList(hdus).writeto(image, clobber=True)
+
+	if instrument.enabled():
+		instrument.count('files_written')
+		instrument.count('bytes_written', os.path.getsize(image))
+
 
 ############################################################################
 # NAME: ObservationDateString
@@ -430,8 +1381,7 @@ def GetObsDateTime(image, keyword='date-obs', hdu=0):
 def GetHeaderKeyword(image, keyword, hdu=0):
 	
 	try:
-		hdulist = pyfits.open(image)			# Open the image
-		value = hdulist[hdu].header[keyword]	# Extract the keyword
+		value = GetHeader(image, hdu)[keyword.upper()]	# Extract the keyword
 	except (IOError, KeyError), e:
 		print "GetHeaderKeyword: "
 		print e									# Send the error message to stdout
@@ -439,6 +1389,210 @@ def GetHeaderKeyword(image, keyword, hdu=0):
 
 	return value
 
+############################################################################
+# NAME: GetHeader
+#
+# DESCRIPTION:
+# 	Return the header of an image through the process-wide header cache.
+#	The file is only opened (and closed again) on a cache miss.  The least
+#	recently used headers are dropped once HEADER_CACHE_SIZE is exceeded.
+#
+# PARAMETERS:
+# 	image - image to extract header from
+#
+# OPTIONAL PARAMETERS:
+#	hdu - The header data unit.  Default is 0 (first one).
+#
+# RETURNS:
+#	The header.  Raises IOError if the image can't be read.
+#
+############################################################################
+def GetHeader(image, hdu=0):
+
+	key = (os.path.abspath(image), hdu)
+
+	try:
+		header = _header_cache.pop(key)		# Hit: re-inserted as most recent below
+		instrument.cache('header_cache', True)
+	except KeyError:
+		instrument.cache('header_cache', False)
+		# SQLite connections can't be shared with forked workers
+		if hdu == 0 and _header_index is not None and _header_index_pid == os.getpid():
+			try:
+				header = IndexedHeader(_header_index.header(image))
+			except OSError, e:
+				raise IOError(str(e))
+		else:
+			header = pyfits.getheader(image, hdu)
+			instrument.count('files_opened')
+
+	_header_cache[key] = header
+	while len(_header_cache) > HEADER_CACHE_SIZE:
+		_header_cache.popitem(last=False)
+
+	return header
+
+############################################################################
+# NAME: IndexedHeader
+#
+# DESCRIPTION:
+# 	Build a pyfits Header from the keyword dictionary kept by a HeaderIndex,
+#	so GetHeader returns the same type whichever way the header was read.
+#	The index doesn't keep the card order: the structural keywords come
+#	first, in the order FITS requires, then the rest sorted by name.
+#	Keywords the index couldn't store (value None) are left out.
+#
+# PARAMETERS:
+# 	values - dictionary of keyword -> value
+#
+# RETURNS:
+#	The header.
+#
+############################################################################
+def IndexedHeader(values):
+
+	naxis = values.get('NAXIS') or 0
+	first = ['SIMPLE', 'BITPIX', 'NAXIS'] + ['NAXIS%d' % i for i in range(1, naxis + 1)] + ['EXTEND']
+	rest = sorted(k for k in values if k not in first)
+
+	header = pyfits.Header()
+	for k in first + rest:
+		v = values.get(k)
+		if v is None:
+			continue
+		if isinstance(v, unicode):
+			v = v.encode('ascii', 'replace')	# Header values are ASCII
+		header[str(k)] = v
+
+	return header
+
+############################################################################
+# NAME: UseHeaderIndex
+#
+# DESCRIPTION:
+# 	Serve primary headers from a persistent header index (header_index.py)
+#	instead of opening the files, so FindBiasFrame, FindDarkFrame,
+#	FindFlatFrame and the stages look up DATE-OBS, EXPTIME and FILTER with
+#	indexed reads.  Worker processes fall back to reading the files.
+#
+# PARAMETERS:
+# 	index - a HeaderIndex, or None to read the files again
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def UseHeaderIndex(index):
+	global _header_index, _header_index_pid
+
+	_header_index = index
+	_header_index_pid = os.getpid()
+	InvalidateHeaderCache()
+
+############################################################################
+# NAME: InvalidateHeaderCache
+#
+# DESCRIPTION:
+# 	Drop cached headers for files that have been rewritten, renamed or removed.
+#
+# OPTIONAL PARAMETERS:
+#	images - an image or list of images to forget.  Default clears the cache.
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def InvalidateHeaderCache(images=None):
+
+	if images is None:
+		_header_cache.clear()
+		return
+
+	if isinstance(images, basestring):
+		images = [images]
+
+	paths = set(os.path.abspath(i) for i in images)
+	for key in [k for k in _header_cache if k[0] in paths]:
+		del _header_cache[key]
+
+############################################################################
+# NAME: OutputUnchanged
+#
+# DESCRIPTION:
+# 	Check whether an output was made by an earlier run from the same inputs
+#	and none of them (nor the output) has changed since, judged by size and
+#	mtime.  A new master bias/dark/flat, a rewritten raw frame or a different
+#	choice of calibration frame makes the output out of date.  Always False
+#	when SKIP_UNCHANGED is off.
+#
+# PARAMETERS:
+# 	output - the output image
+#	inputs - list of images the output is made from
+#	params - dictionary of the parameters of the operation
+#
+# RETURNS:
+#	True if the output can be kept as it is.
+#
+############################################################################
+def OutputUnchanged(output, inputs, params):
+
+	if not SKIP_UNCHANGED or not os.path.exists(output):
+		return False
+
+	if not Provenance(output).unchanged(output, inputs, params):
+		return False
+
+	print output + " is up to date"
+	return True
+
+############################################################################
+# NAME: RecordProvenance
+#
+# DESCRIPTION:
+# 	Record what the outputs of a stage were made from, for OutputUnchanged.
+#
+# PARAMETERS:
+# 	outputs - list of output images; the null string for one not written
+#	sources - list of (inputs, params), one per output
+#
+# RETURNS:
+#	No return value.
+#
+############################################################################
+def RecordProvenance(outputs, sources):
+
+	stores = set()
+	for output, (inputs, params) in zip(outputs, sources):
+		if output != "" and os.path.exists(output):
+			store = Provenance(output)
+			store.record(output, inputs, params, commit=False)
+			stores.add(store)
+
+	for store in stores:
+		store.commit()
+
+############################################################################
+# NAME: Provenance
+#
+# DESCRIPTION:
+# 	Return the provenance store (provenance.py) of the directory an output is
+#	written to, opening it on first use.  Each process opens its own, since
+#	SQLite connections can't be shared with forked workers.
+#
+# PARAMETERS:
+# 	output - an output image
+#
+# RETURNS:
+#	The ProvenanceStore
+#
+############################################################################
+def Provenance(output):
+
+	key = (os.getpid(), os.path.dirname(os.path.abspath(output)))
+	if key not in _provenance:
+		_provenance[key] = ProvenanceStore(key[1])
+	return _provenance[key]
+
 ############################################################################
 # NAME: CleanAncillary
 #
@@ -459,6 +1613,8 @@ def CleanAncillary(files):
 		if os.path.exists(f):
 			os.remove(f)
 
+	InvalidateHeaderCache(files)
+
 
 ############################################################################
 # NAME: fits_filter
@@ -507,6 +1663,7 @@ def FixFilenames(files):
 		print "Original: " + files[i] + " Replace: " + outf[i]
 		if outf[i] != files[i]:
 			os.rename(files[i], outf[i])
+			InvalidateHeaderCache([files[i], outf[i]])
 
 	return(outf)
 
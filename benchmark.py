@@ -0,0 +1,422 @@
+# Benchmarks for the reduction pipeline
+# Generates a synthetic night of raw frames (biases, darks at every exposure
+# time, flats in every filter and science frames), builds the masters into a
+# cal_path/<date>/... tree and times every stage on it. Each stage runs in a
+# fresh process, so its peak memory and its calibration/header caches are its
+# own. Results are saved as JSON so runs can be compared over time:
+#     python benchmark.py --frames 200 --shape 1024 1024 --workers 4
+#     python benchmark.py --compare benchmark-20140330-120000.json
+# Nothing is downloaded; the data is made with numpy in a temporary directory.
+##########
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import resource
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+
+import PipeLineSupport
+import instrument
+import MasterDark_BiasSub_Test7 as MasterDark
+import cat_creator
+
+
+##########
+# DESCRIPTION
+#   reads the command line, generates the night, runs the stages and saves
+#   the results
+# PARAMETERS
+#   args - the command line options
+#   night - description of the generated night, see make_night()
+#   results - the benchmark results, see run()
+# RETURNS
+#   nothing
+##########
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the pipeline stages on synthetic data')
+    parser.add_argument('--frames', type=int, default=50, help='science frames')
+    parser.add_argument('--cal-frames', type=int, default=5, help='raw frames per master')
+    parser.add_argument('--shape', type=int, nargs=2, default=[512, 512], metavar=('ROWS', 'COLUMNS'))
+    parser.add_argument('--dtype', default='uint16', choices=sorted(RAW_TYPES))
+    parser.add_argument('--exposures', type=float, nargs='+', default=[10.0, 30.0, 60.0])
+    parser.add_argument('--filters', nargs='+', default=['R', 'V'])
+    parser.add_argument('--night', default='20140330', help='observing night, YYYYMMDD')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--stages', nargs='+', default=[s[0] for s in STAGES],
+                        choices=[s[0] for s in STAGES])
+    parser.add_argument('--base', help='where the night is generated (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated data')
+    parser.add_argument('--output', help='results file (default: benchmark-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--instrument', action='store_true',
+                        help='add the instrument report of every stage to the results')
+    args = parser.parse_args()
+    instrument.enable(args.instrument)
+
+    base = args.base or tempfile.mkdtemp(prefix='benchmark')
+    try:
+        night = make_night(base, args.night, args.frames, args.cal_frames, tuple(args.shape),
+                           args.dtype, args.exposures, args.filters)
+        results = run(night, args.stages, args.workers)
+    finally:
+        if not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+
+    output = args.output or time.strftime('benchmark-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print_results(results)
+    print 'saved to ' + output
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+# stored pixel types the raw frames can be written with
+RAW_TYPES = {'uint16': np.uint16, 'int16': np.int16, 'int32': np.int32, 'float32': np.float32}
+
+# levels of the synthetic frames, in counts and counts per second
+BIAS_LEVEL = 1000.0
+READ_NOISE = 5.0
+DARK_RATE = 0.5
+SKY_RATE = 20.0
+FLAT_LEVEL = 20000.0
+FLAT_EXPTIME = 5.0
+
+
+##########
+# DESCRIPTION
+#   Writes a synthetic night: raw biases, darks at every exposure time,
+#   flats in every filter and science frames cycling through the exposure
+#   times and filters, all in base/raw/<night>. Masters go to base/cal, which
+#   build_masters fills in
+# PARAMETERS
+#   base - directory to generate the night in
+#   night - observing night, YYYYMMDD
+#   frames - number of science frames
+#   cal_frames - raw frames per master
+#   shape - (rows, columns) of every frame
+#   dtype - stored pixel type, a key of RAW_TYPES
+#   exposures - exposure times of the science frames and darks
+#   filters - filters of the science frames and flats
+#   rng - random numbers, seeded so every run makes the same data
+#   bias, dark, flat - the true bias level, dark current and flat field
+#   start - DATE-OBS of the first frame, 2 am after the start of the night
+#   kinds - (IMAGETYP, exposure time, filter) of every frame to write
+# RETURN
+#   dictionary describing the night; lists of files under 'calibration',
+#   'science' and 'darks' (the darks of the first exposure time)
+##########
+
+def make_night(base, night, frames, cal_frames, shape, dtype, exposures, filters):
+    raw_path = os.path.join(base, 'raw', night)
+    cal_path = os.path.join(base, 'cal')
+    for d in (raw_path, cal_path):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    rng = np.random.RandomState(0)
+    bias = BIAS_LEVEL + rng.normal(0, 2, shape)
+    dark = DARK_RATE * rng.gamma(2.0, 0.5, shape)
+    flat = dict((f, 1 + 0.05 * rng.standard_normal(shape)) for f in filters)
+    start = datetime.datetime.strptime(night, '%Y%m%d') + datetime.timedelta(hours=26)
+
+    kinds = [('Bias Frame', 0.0, None)] * cal_frames
+    for e in exposures:
+        kinds = kinds + [('Dark Frame', e, None)] * cal_frames
+    for f in filters:
+        kinds = kinds + [('Flat Field', FLAT_EXPTIME, f)] * cal_frames
+    for n in range(frames):
+        kinds.append(('Light Frame', exposures[n % len(exposures)], filters[n % len(filters)]))
+
+    described = {'calibration': [], 'science': [], 'darks': []}
+    for n, (imagetyp, exptime, ifilter) in enumerate(kinds):
+        data = bias + dark * exptime + rng.normal(0, READ_NOISE, shape)
+        if imagetyp == 'Flat Field':
+            data += flat[ifilter] * FLAT_LEVEL
+        elif imagetyp == 'Light Frame':
+            data += flat[ifilter] * SKY_RATE * exptime
+
+        head = fits.Header()
+        head['IMAGETYP'] = imagetyp
+        head['EXPTIME'] = exptime
+        head['EXPOSURE'] = exptime
+        head['DATE-OBS'] = (start + datetime.timedelta(seconds=n)).strftime('%Y-%m-%dT%H:%M:%S')
+        head['AIRMASS'] = 1.2
+        head['FOCUS'] = 3000.0
+        head['OBJECT'] = 'SYNTHETIC'
+        if ifilter is not None:
+            head['FILTER'] = ifilter
+
+        x = os.path.join(raw_path, 'synth_%05d.fits' % n)
+        fits.PrimaryHDU(stored(data, dtype), head).writeto(x, overwrite=True)
+
+        if imagetyp == 'Light Frame':
+            described['science'].append(x)
+        else:
+            described['calibration'].append(x)
+            if imagetyp == 'Dark Frame' and exptime == exposures[0]:
+                described['darks'].append(x)
+
+    described.update({'base': base, 'raw_path': raw_path, 'cal_path': cal_path, 'night': night,
+                      'frames': frames, 'cal_frames': cal_frames, 'shape': list(shape),
+                      'dtype': dtype, 'exposures': list(exposures), 'filters': list(filters)})
+    return described
+
+
+##########
+# DESCRIPTION
+#   converts synthetic pixels to the stored type; integer types are rounded
+#   and clipped to their range
+# PARAMETERS
+#   data - the pixels
+#   dtype - a key of RAW_TYPES
+# RETURN
+#   the pixels as the stored type
+##########
+
+def stored(data, dtype):
+    t = np.dtype(RAW_TYPES[dtype])
+    if t.kind in 'iu':
+        info = np.iinfo(t)
+        data = np.clip(np.round(data), info.min, info.max)
+    return data.astype(t)
+
+
+##########
+# DESCRIPTION
+#   the stages; each takes the night and its input frames and returns the
+#   frames it wrote, which a later stage may take as its input
+##########
+
+def stage_masters(night, frames, workers):
+    return MasterDark.build_masters(night['raw_path'], night['cal_path'], processes=workers)
+
+def stage_bias(night, frames, workers):
+    return PipeLineSupport.BiasSubtract(frames, night['cal_path'], backend='numpy', workers=workers)
+
+def stage_dark(night, frames, workers):
+    return PipeLineSupport.DarkSubtract(frames, night['cal_path'], backend='numpy', workers=workers)
+
+def stage_flat(night, frames, workers):
+    return PipeLineSupport.FlatField(frames, night['cal_path'], backend='numpy', workers=workers)
+
+def stage_normalize(night, frames, workers):
+    return PipeLineSupport.ExpNormalize(frames, backend='numpy', workers=workers)
+
+def stage_calibrate(night, frames, workers):
+    return PipeLineSupport.Calibrate(frames, night['cal_path'], workers=workers)
+
+def stage_batch(night, frames, workers):
+    return PipeLineSupport.Calibrate(frames, night['cal_path'], workers=workers, batch=True)
+
+def stage_getmean(night, frames, workers):
+    MasterDark.getmean(frames, '')
+    return []
+
+def stage_catalog(night, frames, workers):
+    catalog = os.path.join(night['base'], 'catalog.fits')
+    if os.path.exists(catalog):
+        os.remove(catalog)
+    cat_creator.write_catalog(frames, catalog)
+    return [catalog]
+
+
+# (name, function, where its input frames come from); the source is a list
+# of make_night() or the name of an earlier stage
+STAGES = [('build_masters', stage_masters, 'calibration'),
+          ('BiasSubtract', stage_bias, 'science'),
+          ('DarkSubtract', stage_dark, 'BiasSubtract'),
+          ('FlatField', stage_flat, 'DarkSubtract'),
+          ('ExpNormalize', stage_normalize, 'FlatField'),
+          ('Calibrate', stage_calibrate, 'science'),
+          ('CalibrateBatch', stage_batch, 'science'),
+          ('getmean', stage_getmean, 'darks'),
+          ('catalog', stage_catalog, 'science')]
+
+
+##########
+# DESCRIPTION
+#   Runs the stages in order, each in its own process, and measures them.
+#   The masters are always built first when a calibration stage is asked
+#   for, since those stages need them. Chained stages whose earlier stage was
+#   not asked for take the output of the stages before it
+# PARAMETERS
+#   night - the generated night, see make_night()
+#   stages - names of the stages to run
+#   workers - worker processes given to every stage
+#   frames - input frames of every source, by name
+#   measured - measurements of one stage, see measure()
+# RETURN
+#   dictionary of the run: machine, configuration and one entry per stage
+##########
+
+def run(night, stages, workers=1):
+    frames = dict((k, night[k]) for k in ('calibration', 'science', 'darks'))
+    needs_masters = set(['BiasSubtract', 'DarkSubtract', 'FlatField', 'ExpNormalize',
+                         'Calibrate', 'CalibrateBatch'])
+    wanted = set(stages)
+    if wanted & needs_masters:
+        wanted.add('build_masters')
+
+    results = {'created': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+               'host': platform.node(),
+               'machine': platform.machine(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'cpus': multiprocessing.cpu_count(),
+               'workers': workers,
+               'config': dict((k, night[k]) for k in ('frames', 'cal_frames', 'shape', 'dtype',
+                                                      'exposures', 'filters', 'night')),
+               'stages': []}
+
+    for name, function, source in STAGES:
+        inputs = frames.get(source, [])
+        if name not in wanted:
+            # a skipped chained stage passes its input on unchanged
+            frames[name] = inputs
+            continue
+        measured, frames[name] = measure(name, function, night, inputs, workers)
+        results['stages'].append(measured)
+
+    return results
+
+
+##########
+# DESCRIPTION
+#   Runs one stage in a child process and measures it
+# PARAMETERS
+#   name - the stage name
+#   function - the stage function
+#   night - the generated night
+#   inputs - input frames of the stage
+#   workers - worker processes given to the stage
+#   size - bytes of input frames
+# RETURN
+#   (measurements, frames the stage wrote); measurements holds the wall
+#   time, throughput in frames and MB per second, mean latency per frame,
+#   the peak resident memory of the stage and its workers and, when
+#   instrumentation is on, the instrument report of the stage
+##########
+
+def measure(name, function, night, inputs, workers):
+    receive, send = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.Process(target=run_stage, args=(send, function, night, inputs, workers))
+    child.start()
+    send.close()
+    try:
+        result = receive.recv()
+    except EOFError:
+        result = ('stage process died', None, None, [], None)
+    child.join()
+
+    error, seconds, rss, outputs, recorded = result
+    size = sum(os.path.getsize(x) for x in inputs if os.path.exists(x))
+    n = len(inputs)
+
+    measured = {'stage': name, 'frames': n, 'bytes': size}
+    if error is not None:
+        print '%s failed: %s' % (name, error)
+        measured['error'] = error
+        return measured, []
+
+    measured['seconds'] = seconds
+    measured['frames_per_second'] = n / seconds if seconds > 0 else None
+    measured['mb_per_second'] = size / 1024.0**2 / seconds if seconds > 0 else None
+    measured['latency_ms'] = 1000.0 * seconds / n if n else None
+    measured['peak_rss_mb'] = rss / 1024.0
+    if recorded is not None:
+        measured['instrument'] = recorded
+    return measured, outputs
+
+
+##########
+# DESCRIPTION
+#   body of the stage process; sends back (error, seconds, peak rss in kB,
+#   frames written, instrument report or None). ru_maxrss of the children
+#   covers the stage's own pool
+# PARAMETERS
+#   conn - end of the pipe to send the result on
+#   function, night, inputs, workers - the stage and its arguments
+#   out - stdout while the stage runs; the stages print every frame
+##########
+
+def run_stage(conn, function, night, inputs, workers):
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    instrument.reset()
+    # every stage must do its work, even where an earlier stage made the same output
+    PipeLineSupport.SKIP_UNCHANGED = False
+    try:
+        start = time.time()
+        outputs = function(night, inputs, workers)
+        seconds = time.time() - start
+        rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        recorded = instrument.report() if instrument.enabled() else None
+        result = (None, seconds, rss, outputs, recorded)
+    except Exception, e:
+        result = ('%s: %s' % (type(e).__name__, e), None, None, [], None)
+    finally:
+        sys.stdout = out
+    conn.send(result)
+    conn.close()
+
+
+##########
+# DESCRIPTION
+#   prints the results as a table
+# PARAMETERS
+#   results - the benchmark results, see run()
+##########
+
+def print_results(results):
+    c = results['config']
+    print '%d science frames of %dx%d %s, %d workers' % (c['frames'], c['shape'][0], c['shape'][1],
+                                                        c['dtype'], results['workers'])
+    print '%-15s %7s %9s %9s %9s %11s %9s' % ('stage', 'frames', 'seconds', 'frames/s',
+                                              'MB/s', 'ms/frame', 'peak MB')
+    for s in results['stages']:
+        if 'error' in s:
+            print '%-15s %7d  failed: %s' % (s['stage'], s['frames'], s['error'])
+            continue
+        print '%-15s %7d %9.3f %9s %9s %11s %9.1f' % (
+            s['stage'], s['frames'], s['seconds'], number(s['frames_per_second']),
+            number(s['mb_per_second']), number(s['latency_ms']), s['peak_rss_mb'])
+
+
+def number(x):
+    return '-' if x is None else '%.1f' % x
+
+
+##########
+# DESCRIPTION
+#   prints how much slower or faster every stage is than in an earlier run
+# PARAMETERS
+#   old, new - benchmark results, see run()
+#   before - seconds of every stage in the earlier run
+##########
+
+def compare(old, new):
+    if old.get('config') != new.get('config'):
+        print 'note: the runs used different configurations'
+    before = dict((s['stage'], s.get('seconds')) for s in old['stages'])
+    print '%-15s %9s %9s %8s' % ('stage', 'before', 'after', 'ratio')
+    for s in new['stages']:
+        a, b = before.get(s['stage']), s.get('seconds')
+        if a and b:
+            print '%-15s %9.3f %9.3f %7.2fx' % (s['stage'], a, b, b / a)
+
+
+if __name__ == "__main__": main()
@@ -7,15 +7,44 @@ C:\Users\Maria\.spyder2\.temp.py
 """
 
 from astropy.io import fits
+from fits_access import header_records
+from header_index import HeaderIndex
+import instrument
 import os
+import re
+import csv
+import json
+import urllib
+import datetime
+import multiprocessing
+import numpy as np
+
+# Parquet output is optional; without pyarrow the catalog falls back to CSV
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# header keywords that make up one catalog row
+CATALOG_KEYWORDS = ['EXPTIME', 'AIRMASS', 'FOCUS', 'DATE-OBS', 'OBJECT']
+
+# structured catalog written by main(); .fits, .parquet or .csv
+CATALOG_NAME = 'catalog.fits'
+
+# columns of the structured catalog and their types
+CATALOG_COLUMNS = [('FILE', str), ('FILENUM', str), ('EXPTIME', float),
+                   ('DATE-OBS', datetime.datetime), ('AIRMASS', float),
+                   ('FOCUS', float), ('OBJECT', str)]
 
 ##########
 # DESCRIPTION
-#	Starts at base_path and it will call functions that create a text catalog.
+#	Starts at base_path and it will call functions that create a catalog.
 # PARAMETERS
 #	base_path - where you want the program to start running
 #	images - the fits files in the current path
-#	list - calls the function that will write the text file
+#	index - header index kept in base_path so re-runs only read new files
+#	added - how many new files were appended to the catalog
 # RETURNS
 #	nothing
 ##########
@@ -26,7 +55,12 @@ def main():
     print os.getcwd()
     files = os.listdir(base_path)    
     images = sort(files)
-    file(images)
+    index = HeaderIndex(base_path)
+    added = write_catalog(images, CATALOG_NAME, index)
+    index.close()
+    print '%d new files added to %s' % (added, CATALOG_NAME)
+    if instrument.enabled():
+        instrument.print_report()
             
             
 ##########
@@ -52,6 +86,8 @@ def sort(files):
 #     the text file.
 # PARAMETERS
 #	images - list of fits image names
+#     index  - header index to read from (optional)
+#     records- one header record per image, each file is opened only once
 #	filter - list of objects observed
 #	exp    - list of exposure times
 #	time   - list of times when the images were taken
@@ -62,13 +98,17 @@ def sort(files):
 #	nothing
 ##########
 
-def file(images):
+def file(images, index=None):
     filenum = filenum_build(images)
-    filter = color_build(images)
-    exp = exp_List_build(images)
-    air = Airmass_build(images)
-    foc = Focus_build(images)    
-    time = date_build(images)
+    if index is not None:
+        records = index.records(images, CATALOG_KEYWORDS)
+    else:
+        records = header_records(images, CATALOG_KEYWORDS)
+    filter = [r['OBJECT'] for r in records]
+    exp = [r['EXPTIME'] for r in records]
+    air = [r['AIRMASS'] for r in records]
+    foc = [r['FOCUS'] for r in records]
+    time = [r['DATE-OBS'] for r in records]
     # creates a new catalog and puts into the variable info
     info = open("Prettycatalog.txt", "w")
     # writes information to file
@@ -85,6 +125,330 @@ def file(images):
 
     info.close()
     
+##########
+# DESCRIPTION
+#	Appends the images to a structured catalog with typed columns
+#     (see CATALOG_COLUMNS). Files already in the catalog are skipped
+#     without reading their headers, so re-runs only add new frames.
+#       .fits    - every run appends one binary table extension
+#       .parquet - a directory; every run adds one part file
+#       .csv     - every run appends rows
+#     Parquet needs pyarrow; without it a .csv next to it is written instead
+# PARAMETERS
+#	images - list of fits image names
+#     catalog - the catalog file
+#     index  - header index to read from (optional)
+#     extra  - dictionary of extra column name -> list of values (optional)
+#     records- header records of the images if already read (optional)
+#     done   - files already in the catalog
+#     columns- dictionary of column name -> list of typed values
+# RETURNS
+#	how many images were added
+##########
+
+@instrument.stage
+def write_catalog(images, catalog=CATALOG_NAME, index=None, extra=None, records=None):
+    catalog = catalog_path(catalog)
+    done = catalog_files(catalog)
+    done.add(os.path.basename(catalog))     # a .fits catalog sits among the images
+    new = [n for n, i in enumerate(images) if i not in done]
+    if not new:
+        return 0
+
+    images = [images[n] for n in new]
+    if records is not None:
+        records = [records[n] for n in new]
+    elif index is not None:
+        records = index.records(images, CATALOG_KEYWORDS)
+    else:
+        records = header_records(images, CATALOG_KEYWORDS)
+
+    columns = catalog_columns(images, records)
+    names = [c[0] for c in CATALOG_COLUMNS]
+    for k, v in sorted((extra or {}).items()):
+        columns[k] = [v[n] for n in new]
+        names.append(k)
+
+    ext = os.path.splitext(catalog)[1].lower()
+    if ext == '.parquet':
+        write_parquet(catalog, names, columns)
+    elif ext == '.csv':
+        write_csv(catalog, names, columns)
+    else:
+        write_fits_table(catalog, names, columns)
+
+    return len(images)
+
+
+##########
+# DESCRIPTION
+#	Catalogs a whole archive into one catalog with a NIGHT column. Every
+#     directory under base_path that holds fits files is a night. Nights are
+#     read in parallel, each through its own header index, and only nights
+#     whose directory changed since the last run are read again. The header
+#     indexes are kept next to the catalog, not in the nights, so reading a
+#     night doesn't change its mtime and read-only nights can be cataloged.
+#     FILE is the path relative to base_path
+# PARAMETERS
+#	base_path - top of the archive
+#     catalog - the catalog file
+#     processes - size of the process pool (default: one per cpu)
+#     state  - night -> directory mtime at the last run, kept next to the catalog
+#     indexes- directory of the nights' header indexes
+#     changed- nights to read this run
+# RETURNS
+#	how many images were added
+##########
+
+@instrument.stage
+def archive(base_path, catalog, processes=None):
+    state_file = catalog_path(catalog) + '.nights'
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    # the catalog itself may sit inside the archive
+    exclude = os.path.abspath(catalog_path(catalog))
+
+    nights = {}
+    for root, dirs, files in os.walk(base_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not d.endswith('.parquet'))
+        files = [f for f in files if os.path.abspath(os.path.join(root, f)) != exclude]
+        if sort(files):
+            nights[os.path.relpath(root, base_path)] = os.stat(root).st_mtime
+
+    changed = sorted(n for n in nights if state.get(n) != nights[n])
+    if not changed:
+        return 0
+
+    indexes = os.path.abspath(catalog_path(catalog)) + '.indexes'
+    if not os.path.isdir(indexes):
+        os.makedirs(indexes)
+    tasks = [(base_path, n, exclude, os.path.join(indexes, urllib.quote(n, safe='') + '.sqlite'))
+             for n in changed]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        scanned = instrument.pool_map(pool, scan_night, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    images, records, night_column = [], [], []
+    for night, files, recs in scanned:
+        images.extend(os.path.join(night, f) for f in files)
+        records.extend(recs)
+        night_column.extend([night] * len(files))
+
+    added = write_catalog(images, catalog, extra={'NIGHT': night_column}, records=records)
+
+    for n in changed:
+        state[n] = nights[n]
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+
+    return added
+
+
+##########
+# DESCRIPTION
+#	Reads the catalog keywords of every fits file of one night; runs in a
+#     worker process of archive()
+# PARAMETERS
+#	task - (base_path, night, file to leave out, header index file)
+# RETURNS
+#	(night, list of fits files, list of header records)
+##########
+
+@instrument.frame(lambda task: task[1])
+def scan_night(task):
+    base_path, night, exclude, index_file = task
+    path = os.path.join(base_path, night)
+    files = sort(sorted(os.listdir(path)))
+    files = [f for f in files if os.path.abspath(os.path.join(path, f)) != exclude]
+    index = HeaderIndex(path, index_file)
+    try:
+        records = index.records(files, CATALOG_KEYWORDS, path)
+    finally:
+        index.close()
+    return night, files, records
+
+
+##########
+# DESCRIPTION
+#	Turns header records into typed catalog columns
+# PARAMETERS
+#	images - list of fits image names
+#     records- one header record per image
+# RETURNS
+#	dictionary of column name -> list of values
+##########
+
+def catalog_columns(images, records):
+    columns = {}
+    columns['FILE'] = list(images)
+    columns['FILENUM'] = filenum_build(images)
+    for name, kind in CATALOG_COLUMNS[2:]:
+        columns[name] = [typed(r[name], kind) for r in records]
+    return columns
+
+
+##########
+# DESCRIPTION
+#	Converts a header value to a catalog column type; missing or bad
+#     values become NaN, None or ''
+# PARAMETERS
+#	value - the header value
+#     kind  - float, str or datetime.datetime
+# RETURNS
+#	the converted value
+##########
+
+def typed(value, kind):
+    if kind is float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+    if kind is datetime.datetime:
+        try:
+            return datetime.datetime.strptime(str(value)[:19], '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            return None
+    if value is None:
+        return ''
+    return str(value)
+
+
+##########
+# DESCRIPTION
+#	Picks the catalog file actually written: a .parquet catalog becomes a
+#     .csv when pyarrow is not installed
+# PARAMETERS
+#	catalog - the catalog file asked for
+# RETURNS
+#	the catalog file to use
+##########
+
+def catalog_path(catalog):
+    name, ext = os.path.splitext(catalog)
+    if ext.lower() == '.parquet' and pyarrow is None:
+        print 'pyarrow is not installed, writing ' + name + '.csv instead'
+        return name + '.csv'
+    return catalog
+
+
+##########
+# DESCRIPTION
+#	Reads the FILE column of an existing catalog
+# PARAMETERS
+#	catalog - the catalog file
+# RETURNS
+#	set of file names already in the catalog
+##########
+
+def catalog_files(catalog):
+    if not os.path.exists(catalog):
+        return set()
+
+    ext = os.path.splitext(catalog)[1].lower()
+    if ext == '.parquet':
+        table = pyarrow.parquet.read_table(catalog, columns=['FILE'])
+        return set(table.column('FILE').to_pylist())
+    if ext == '.csv':
+        with open(catalog, 'rb') as f:
+            return set(row['FILE'] for row in csv.DictReader(f))
+
+    done = set()
+    hdulist = fits.open(catalog)
+    for hdu in hdulist[1:]:
+        done.update(hdu.data['FILE'])
+    hdulist.close()
+    return done
+
+
+##########
+# DESCRIPTION
+#	Appends the rows as a new binary table extension of a fits catalog
+# PARAMETERS
+#	catalog - the catalog file
+#     names  - column names in order
+#     columns- dictionary of column name -> list of values
+# RETURNS
+#	nothing
+##########
+
+def write_fits_table(catalog, names, columns):
+    cols = []
+    for name in names:
+        values = columns[name]
+        if values and isinstance(values[0], float):
+            cols.append(fits.Column(name=name, format='D', array=np.array(values)))
+        else:
+            if name == 'DATE-OBS':
+                values = [v.strftime('%Y-%m-%dT%H:%M:%S') if v else '' for v in values]
+            width = max([len(v) for v in values] + [1])
+            cols.append(fits.Column(name=name, format='%dA' % width, array=np.array(values)))
+
+    table = fits.BinTableHDU.from_columns(cols, name='CATALOG')
+    if os.path.exists(catalog):
+        fits.append(catalog, table.data, table.header)
+    else:
+        fits.HDUList([fits.PrimaryHDU(), table]).writeto(catalog)
+
+
+##########
+# DESCRIPTION
+#	Adds the rows as a new part file of a parquet catalog directory
+# PARAMETERS
+#	catalog - the catalog directory
+#     names  - column names in order
+#     columns- dictionary of column name -> list of values
+# RETURNS
+#	nothing
+##########
+
+def write_parquet(catalog, names, columns):
+    if not os.path.isdir(catalog):
+        os.makedirs(catalog)
+    part = len([f for f in os.listdir(catalog) if f.endswith('.parquet')])
+
+    arrays = []
+    for name in names:
+        if name == 'DATE-OBS':
+            arrays.append(pyarrow.array(columns[name], type=pyarrow.timestamp('s')))
+        else:
+            arrays.append(pyarrow.array(columns[name]))
+    table = pyarrow.Table.from_arrays(arrays, names)
+    pyarrow.parquet.write_table(table, os.path.join(catalog, 'part-%05d.parquet' % part))
+
+
+##########
+# DESCRIPTION
+#	Appends the rows to a CSV catalog, writing the column names first if
+#     the file is new
+# PARAMETERS
+#	catalog - the catalog file
+#     names  - column names in order
+#     columns- dictionary of column name -> list of values
+# RETURNS
+#	nothing
+##########
+
+def write_csv(catalog, names, columns):
+    new = not os.path.exists(catalog)
+    with open(catalog, 'ab') as f:
+        out = csv.writer(f)
+        if new:
+            out.writerow(names)
+        for n in range(len(columns['FILE'])):
+            row = [columns[name][n] for name in names]
+            row = [v.strftime('%Y-%m-%dT%H:%M:%S') if isinstance(v, datetime.datetime) else v
+                   for v in row]
+            out.writerow(row)
+    
+
 ##########
 # DISCRIPTION
 #   builds a list called filnum that contains filenumbers
@@ -101,19 +465,22 @@ def filenum_build(images):
 
 ##########
 # DISCRIPTION
-#   loops through the filename and picks out the 4 character filenumber
+#   picks out the filenumber: the last run of digits in the file name,
+#   e.g. mar30_0001.fits -> 0001
 # PARAMETERS
-#   f - constructs the filenumber
+#   x - file name, may include directories
+#   m - the match of FILENUM_PATTERN
 # RETURNS
-#   f - returns the filenumber back to filenum_build
+#   the filenumber, or '' if the name has no digits
 ##########
+
+FILENUM_PATTERN = re.compile(r'(\d+)\D*$')
+
 def filename(x):
-    for i in x:
-       f =""
-       for j in range(len(x)):
-           if j > 5 and j <10:
-               f = f + x[j]
-    return f
+    m = FILENUM_PATTERN.search(os.path.splitext(os.path.basename(x))[0])
+    if m is None:
+        return ''
+    return m.group(1)
             
 """def extract(x):
     f =""
@@ -0,0 +1,483 @@
+# Shared FITS access routines for the UST Observatory scripts
+# Reads headers without touching the image data so catalog and selection
+# passes only cost one small read per file, reads image data a few rows
+# at a time through memory maps without copying it, and reads ahead in a
+# background thread so disk reads overlap with the work on the frame before.
+##########
+
+import os
+import re
+import sys
+import time
+import datetime
+import threading
+import Queue
+import numpy as np
+import instrument
+
+try:
+    from astropy.io import fits
+except ImportError:
+    import pyfits as fits
+
+
+##########
+# DESCRIPTION
+#   Reads the primary header of a fits file. Only the header blocks up to the
+#   END card are read; the data unit is never opened or mapped.
+# PARAMETERS
+#   x - input file
+#   f - the open file object
+# RETURN
+#   the primary header
+##########
+
+def read_primary_header(x):
+    with open(x, 'rb') as f:
+        head = fits.Header.fromfile(f, endcard=True, padding=True)
+        instrument.count('files_opened')
+        instrument.count('bytes_read', f.tell())
+        return head
+
+
+##########
+# DESCRIPTION
+#   Pulls a set of keywords out of one header into a record
+# PARAMETERS
+#   head - the header
+#   keywords - list of header keywords wanted
+#   default - value used when a keyword is missing from the header
+# RETURN
+#   dictionary of keyword -> value
+##########
+
+def header_record(head, keywords, default=None):
+    record = {}
+    for k in keywords:
+        record[k] = head.get(k, default)
+    return record
+
+
+##########
+# DESCRIPTION
+#   Opens each file once and returns every requested keyword in one record
+#   per file, in the same order as the input list
+# PARAMETERS
+#   images - list of fits files
+#   keywords - list of header keywords wanted
+#   path - directory the images are in (optional)
+#   default - value used when a keyword is missing from the header
+# RETURN
+#   list of records, one per image
+##########
+
+def header_records(images, keywords, path='', default=None):
+    records = []
+    for i in images:
+        head = read_primary_header(os.path.join(path, i))
+        records.append(header_record(head, keywords, default))
+    return records
+
+
+##########
+# DESCRIPTION
+#   Opens a fits file with its data memory mapped and unscaled, so slicing
+#   the data only reads the rows asked for
+# PARAMETERS
+#   x - input file
+# RETURN
+#   the hdulist; use scaled_rows to read the data
+##########
+
+def open_mapped(x):
+    return fits.open(x, memmap=True, do_not_scale_image_data=True)
+
+
+##########
+# DESCRIPTION
+#   Turns raw stored values into physical values, physical = BZERO + BSCALE *
+#   raw, doing the arithmetic in dtype. Raw pixels equal to BLANK become NaN.
+#   16-bit frames are exact in float32, so asking for float32 keeps the
+#   working set at half of float64 without losing anything
+# PARAMETERS
+#   raw - unscaled data, e.g. a slice of a memory mapped image
+#   bscale, bzero - the scaling keywords
+#   dtype - type of the returned array
+#   blank - raw value of undefined pixels (optional)
+# RETURN
+#   the physical values as a new array
+##########
+
+def to_physical(raw, bscale=1, bzero=0, dtype=np.float64, blank=None):
+    data = np.array(raw, dtype=dtype)
+    if bscale != 1:
+        data *= data.dtype.type(bscale)
+    if bzero != 0:
+        data += data.dtype.type(bzero)
+    if blank is not None and data.dtype.kind == 'f':
+        data[raw == blank] = np.nan
+    return data
+
+
+##########
+# DESCRIPTION
+#   Reads rows r0:r1 of an image opened with open_mapped and applies
+#   BSCALE/BZERO to them
+# PARAMETERS
+#   hdu - the header data unit
+#   r0, r1 - first and one past the last row
+#   dtype - type of the returned rows
+# RETURN
+#   the rows as a new array
+##########
+
+def scaled_rows(hdu, r0, r1, dtype=np.float64):
+    return to_physical(hdu.data[r0:r1], hdu.header.get('BSCALE', 1),
+                       hdu.header.get('BZERO', 0), dtype, raw_blank(hdu))
+
+
+##########
+# DESCRIPTION
+#   the BLANK value of an integer image, which only applies to integer data
+# PARAMETERS
+#   hdu - the header data unit
+# RETURN
+#   BLANK or None
+##########
+
+def raw_blank(hdu):
+    if hdu.header.get('BITPIX', -32) > 0:
+        return hdu.header.get('BLANK')
+    return None
+
+
+##########
+# DESCRIPTION
+#   Memory mapped image that hands out views of the stored pixels without
+#   copying them. raw is the on-disk array itself (big endian, unscaled);
+#   only the rows asked for are paged in. rows() and data() return physical
+#   values, applying BSCALE/BZERO in the requested dtype; an image that
+#   needs no scaling and is already stored in that dtype is returned as the
+#   mapped view itself, in file (big endian) byte order. Views stay valid
+#   until close()
+#       with MappedImage(x) as image:
+#           strip = image.rows(0, 256, np.float32)
+# PARAMETERS
+#   x - input file
+#   hdu - the header data unit
+##########
+
+class MappedImage(object):
+
+    def __init__(self, x, hdu=0):
+        self.path = x
+        self.hdulist = open_mapped(x)
+        instrument.count('files_opened')
+        unit = self.hdulist[hdu]
+        self.header = unit.header
+        self.raw = unit.data
+        self.shape = unit.shape
+        self.bscale = unit.header.get('BSCALE', 1)
+        self.bzero = unit.header.get('BZERO', 0)
+        self.blank = raw_blank(unit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def scaled(self):
+        return self.bscale != 1 or self.bzero != 0
+
+    def rows(self, r0, r1, dtype=np.float64):
+        return self.view(self.raw[r0:r1], dtype)
+
+    def data(self, dtype=np.float64):
+        return self.view(self.raw, dtype)
+
+    def view(self, raw, dtype):
+        instrument.count('bytes_read', raw.nbytes)
+        if not self.scaled and self.blank is None and raw.dtype.newbyteorder('=') == np.dtype(dtype):
+            return raw
+        return to_physical(raw, self.bscale, self.bzero, dtype, self.blank)
+
+    def close(self):
+        if self.hdulist is not None:
+            self.hdulist.close()
+        self.hdulist = None
+        self.raw = None
+
+
+##########
+# DESCRIPTION
+#   Works out the observing night (YYYYMMDD) a DATE-OBS value belongs to.
+#   The night changes at noon, the same rule PipeLineSupport uses for the
+#   calibration directories
+# PARAMETERS
+#   date_obs - DATE-OBS header value, e.g. 2014-03-31T02:10:00
+# RETURN
+#   the night as a YYYYMMDD string
+##########
+
+def observation_night(date_obs):
+    obs = datetime.datetime.strptime(date_obs[:19], '%Y-%m-%dT%H:%M:%S')
+    if obs.hour < 12:
+        obs = obs - datetime.timedelta(days=1)
+    return obs.strftime('%Y%m%d')
+
+
+##########
+# DESCRIPTION
+#   Reads items ahead of the caller in a background thread. read(item) runs
+#   for the next items while the caller works on the current one; at most
+#   depth results wait in the queue, which caps the memory used. Python 2 has
+#   no asyncio, but file reads release the GIL so a thread overlaps them with
+#   numpy work just as well
+# PARAMETERS
+#   items - list of things to read, in order
+#   read - function that reads one item
+#   depth - how many results may be read ahead
+# RETURN
+#   generator of (item, read(item)) in the order of items; an exception
+#   raised by read is raised again here
+##########
+
+# how many frames or strips are read ahead by default
+PREFETCH_DEPTH = 2
+
+_DONE = object()
+
+def prefetch(items, read, depth=PREFETCH_DEPTH):
+    results = Queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def reader():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                results.put((item, read(item), None))
+            except Exception:
+                results.put((item, None, sys.exc_info()))
+                return
+        results.put(_DONE)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is _DONE:
+                return
+            item, value, error = result
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield item, value
+    finally:
+        # let the reader finish if the caller stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get_nowait()
+            except Queue.Empty:
+                thread.join(0.01)
+
+
+##########
+# DESCRIPTION
+#   Reads (file, r0, r1) strips for prefetch(), keeping the current file open
+#   so consecutive strips of one frame don't reopen it
+# PARAMETERS
+#   shape - expected data dimensions; other frames raise ValueError (optional)
+#   dtype - type of the returned rows
+##########
+
+class StripReader(object):
+
+    def __init__(self, shape=None, dtype=np.float64):
+        self.shape = shape
+        self.dtype = dtype
+        self.path = None
+        self.image = None
+
+    def __call__(self, item):
+        x, r0, r1 = item
+        if x != self.path:
+            self.close()
+            self.image = MappedImage(x)
+            self.path = x
+            if self.shape is not None and self.image.shape != self.shape:
+                raise ValueError('%s is %s, expected %s' % (x, self.image.shape, self.shape))
+        return self.image.rows(r0, r1, self.dtype)
+
+    def close(self):
+        if self.image is not None:
+            self.image.close()
+        self.image = None
+        self.path = None
+
+
+##########
+# DESCRIPTION
+#   works out whether a frame is a bias, dark or flat from IMAGETYP
+# PARAMETERS
+#   imagetyp - IMAGETYP header value, e.g. 'Dark Frame'
+# RETURN
+#   'bias', 'dark', 'flat' or None for anything else
+##########
+
+def frame_type(imagetyp):
+    t = str(imagetyp or '').lower()
+    if 'bias' in t or 'zero' in t:
+        return 'bias'
+    if 'dark' in t:
+        return 'dark'
+    if 'flat' in t:
+        return 'flat'
+    return None
+
+
+##########
+# DESCRIPTION
+#   Checks whether a fits file has been completely written: the primary
+#   header must end with an END card and the file must be long enough to
+#   hold the data the header describes
+# PARAMETERS
+#   x - input file
+#   head - the primary header
+#   start - where the data starts in the file
+#   size - bytes of data, padded to whole 2880 byte blocks
+# RETURN
+#   True if the primary HDU is complete
+##########
+
+def fits_complete(x):
+    try:
+        with open(x, 'rb') as f:
+            head = fits.Header.fromfile(f, endcard=True, padding=True)
+            start = f.tell()
+    except (IOError, ValueError, EOFError):
+        return False
+
+    size = abs(head.get('BITPIX', 8)) // 8
+    naxis = head.get('NAXIS', 0)
+    if naxis == 0:
+        size = 0
+    for i in range(1, naxis + 1):
+        size = size * head.get('NAXIS%d' % i, 0)
+    size = ((size + 2879) // 2880) * 2880
+
+    return os.path.getsize(x) >= start + size
+
+
+# directory -> (mtime or None if missing, time checked, set of file names), see listed()
+_listings = {}
+
+# seconds a directory listing is used without checking the directory again
+LISTING_SECONDS = 30.0
+
+
+##########
+# DESCRIPTION
+#   os.path.exists for files in directories that are looked up over and
+#   over (e.g. the calibration tree), answered from listings kept in memory.
+#   A directory is stat'ed at most once every LISTING_SECONDS and listed
+#   again only when its mtime changed, so most calls touch no file at all.
+#   Missing directories are remembered too. A process that writes into one
+#   of these directories must call forget_listings() for what it wrote;
+#   files written by other processes are seen within LISTING_SECONDS.
+#   Symlinked directories are followed
+# PARAMETERS
+#   x - the file
+#   d - its directory
+#   entry - the kept listing of d
+# RETURN
+#   True if x is in its directory
+##########
+
+def listed(x):
+    d, name = os.path.split(os.path.abspath(x))
+    now = time.time()
+    entry = _listings.get(d)
+    if entry is not None and now - entry[1] < LISTING_SECONDS:
+        return name in entry[2]
+
+    try:
+        mtime = os.stat(d).st_mtime
+    except OSError:
+        mtime = None
+
+    if entry is not None and entry[0] == mtime:
+        entry = (mtime, now, entry[2])
+    else:
+        try:
+            names = set(os.listdir(d)) if mtime is not None else set()
+        except OSError:
+            names = set()
+        entry = (mtime, now, names)
+    _listings[d] = entry
+
+    return name in entry[2]
+
+
+##########
+# DESCRIPTION
+#   Drops kept listings, so the next listed() call in those directories
+#   looks at the disk again; called after writing into them
+# PARAMETERS
+#   paths - files (or directories) whose directory listing is dropped;
+#           default drops every listing
+##########
+
+def forget_listings(paths=None):
+    if paths is None:
+        _listings.clear()
+        return
+    for x in paths:
+        x = os.path.abspath(x)
+        _listings.pop(x, None)
+        _listings.pop(os.path.dirname(x), None)
+
+
+# suffixes the calibration stages add to a frame's name, e.g. frame_b_d_f_n
+PRODUCT_SUFFIX = re.compile(r'(_[bdfn])+$')
+
+
+##########
+# DESCRIPTION
+#   Picks out the calibrated products in a directory listing. A file is a
+#   product when it is named like the output of a calibration stage
+#   (frame_b.fits up to frame_b_d_f_n.fits) and the frame it was made from
+#   is in the listing too, so a raw frame that only happens to end in _b,
+#   _d, _f or _n (e.g. m31_b.fits) is not taken for one
+# PARAMETERS
+#   names - file names in one directory
+#   stems - stems of the fits files in names
+#   suffix - the stage suffixes at the end of a stem
+# RETURN
+#   set of the names that are products
+##########
+
+def calibration_products(names):
+    stems = set()
+    for n in names:
+        stem, ext = os.path.splitext(n)
+        if ext in ('.fits', '.fit', '.fts'):
+            stems.add(stem)
+
+    products = set()
+    for n in names:
+        stem, ext = os.path.splitext(n)
+        suffix = PRODUCT_SUFFIX.search(stem)
+        if ext != '.fits' or suffix is None:
+            continue
+        # frame_b_d may be made from frame_b or from frame
+        for cut in range(suffix.start(), len(stem), 2):
+            if stem[:cut] in stems:
+                products.add(n)
+                break
+    return products
@@ -0,0 +1,248 @@
+# Persistent index of fits primary headers
+# Keeps the parsed header of every file in an SQLite file next to the data,
+# keyed on path, size and mtime, so later runs only re-read new or changed files.
+# Every keyword value is also stored in an indexed table so frames can be
+# selected with select() without opening any file.
+##########
+
+import os
+import json
+import sqlite3
+import instrument
+
+from fits_access import read_primary_header, header_record, observation_night, frame_type
+
+# name of the index file created in the data directory
+INDEX_NAME = '.header_index.sqlite'
+
+# header cards that are never stored in the index
+SKIP_KEYWORDS = ('', 'COMMENT', 'HISTORY')
+
+
+##########
+# DESCRIPTION
+#   Turns a header into a plain dictionary that can be stored as JSON
+# PARAMETERS
+#   head - the header
+#   values - dictionary of keyword -> value
+# RETURN
+#   values
+##########
+
+def header_dict(head):
+    values = {}
+    for k in head.keys():
+        if k in SKIP_KEYWORDS or k in values:
+            continue
+        v = head[k]
+        if not isinstance(v, (bool, int, long, float, basestring)):
+            v = None
+        values[k] = v
+    return values
+
+
+class HeaderIndex(object):
+
+    ##########
+    # DESCRIPTION
+    #   Opens (or creates) the header index for a data directory
+    # PARAMETERS
+    #   path - the data directory
+    #   filename - name of the index file inside path, or an absolute path
+    #              to keep the index elsewhere
+    ##########
+
+    def __init__(self, path, filename=INDEX_NAME):
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, filename))
+        self.db.execute('CREATE TABLE IF NOT EXISTS headers ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, header TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS keywords ('
+                        'path TEXT, keyword TEXT, num REAL, text TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS keywords_num ON keywords (keyword, num)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS keywords_text ON keywords (keyword, text)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS keywords_path ON keywords (path)')
+
+        # indexes written before the keywords table existed
+        if self.db.execute('SELECT COUNT(*) FROM keywords').fetchone()[0] == 0:
+            for row in self.db.execute('SELECT path, header FROM headers').fetchall():
+                self._index_keywords(row[0], json.loads(row[1]))
+        self.db.commit()
+        self.entries = None
+        self.parsed = 0
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ##########
+    # DESCRIPTION
+    #   Reads every stored (size, mtime, header) row into memory on first use
+    ##########
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = {}
+            for row in self.db.execute('SELECT path, size, mtime, header FROM headers'):
+                self.entries[row[0]] = [row[1], row[2], row[3]]
+        return self.entries
+
+    ##########
+    # DESCRIPTION
+    #   Returns the stored header of one file, re-parsing the file only when
+    #   it is new or its size or mtime changed since it was indexed
+    # PARAMETERS
+    #   x - input file
+    #   commit - write the change to disk straight away
+    # RETURN
+    #   dictionary of every keyword in the primary header
+    ##########
+
+    def header(self, x, commit=True):
+        entries = self._load()
+        key = os.path.abspath(x)
+        st = os.stat(key)
+        entry = entries.get(key)
+
+        hit = entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime
+        instrument.cache('header_index', hit)
+        if hit:
+            if not isinstance(entry[2], dict):
+                entry[2] = json.loads(entry[2])
+            return entry[2]
+
+        values = header_dict(read_primary_header(key))
+        self.db.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                        (key, st.st_size, st.st_mtime, json.dumps(values)))
+        self._index_keywords(key, values)
+        if commit:
+            self.db.commit()
+        entries[key] = [st.st_size, st.st_mtime, values]
+        self.parsed = self.parsed + 1
+        return values
+
+    ##########
+    # DESCRIPTION
+    #   Same as fits_access.header_records but served from the index
+    # PARAMETERS
+    #   images - list of fits files
+    #   keywords - list of header keywords wanted
+    #   path - directory the images are in (optional)
+    #   default - value used when a keyword is missing from the header
+    # RETURN
+    #   list of records, one per image
+    ##########
+
+    def records(self, images, keywords, path='', default=None):
+        records = []
+        for i in images:
+            head = self.header(os.path.join(path, i), commit=False)
+            records.append(header_record(head, keywords, default))
+        self.db.commit()
+        return records
+
+    ##########
+    # DESCRIPTION
+    #   Drops the entries of files that no longer exist
+    # RETURN
+    #   number of entries removed
+    ##########
+
+    def prune(self):
+        entries = self._load()
+        gone = [p for p in entries if not os.path.exists(p)]
+        for p in gone:
+            self.db.execute('DELETE FROM headers WHERE path = ?', (p,))
+            self.db.execute('DELETE FROM keywords WHERE path = ?', (p,))
+            del entries[p]
+        self.db.commit()
+        return len(gone)
+
+    ##########
+    # DESCRIPTION
+    #   Makes sure every fits file of a list is in the index
+    # PARAMETERS
+    #   images - list of fits files
+    #   path - directory the images are in (optional)
+    # RETURN
+    #   number of files that had to be read
+    ##########
+
+    def update(self, images, path=''):
+        before = self.parsed
+        for i in images:
+            self.header(os.path.join(path, i), commit=False)
+        self.db.commit()
+        return self.parsed - before
+
+    ##########
+    # DESCRIPTION
+    #   Selects frames by header values with indexed lookups, e.g.
+    #       index.select({'EXPTIME': 180.0, 'FRAMETYPE': 'dark', 'NIGHT': '20140330'})
+    #   Besides the header keywords, NIGHT (observing night of DATE-OBS) and
+    #   FRAMETYPE ('bias', 'dark', 'flat' or 'light') can be used. A value of
+    #   (low, high) selects a range. Only files already in the index are
+    #   searched; call update() first for new files
+    # PARAMETERS
+    #   criteria - dictionary of keyword -> value
+    #   keywords - the same given as arguments, for keywords that are valid names
+    # RETURN
+    #   sorted list of absolute paths of the matching files
+    ##########
+
+    def select(self, criteria=None, **keywords):
+        criteria = dict(criteria or {}, **keywords)
+        queries = []
+        args = []
+        for k, v in sorted(criteria.items()):
+            if isinstance(v, tuple):
+                column = 'text' if isinstance(v[0], basestring) else 'num'
+                queries.append('SELECT path FROM keywords WHERE keyword = ? AND %s BETWEEN ? AND ?' % column)
+                args.extend([k.upper(), v[0], v[1]])
+            else:
+                column = 'text' if isinstance(v, basestring) else 'num'
+                queries.append('SELECT path FROM keywords WHERE keyword = ? AND %s = ?' % column)
+                args.extend([k.upper(), v])
+
+        if not queries:
+            queries = ['SELECT path FROM headers']
+
+        rows = self.db.execute(' INTERSECT '.join(queries), args)
+        return sorted(row[0] for row in rows)
+
+    ##########
+    # DESCRIPTION
+    #   Replaces the searchable keyword rows of one file
+    # PARAMETERS
+    #   key - absolute path of the file
+    #   values - dictionary of every keyword in the primary header
+    ##########
+
+    def _index_keywords(self, key, values):
+        rows = []
+        for k, v in values.items():
+            if v is None:
+                continue
+            if isinstance(v, basestring):
+                rows.append((key, k, None, v.strip()))
+            else:
+                rows.append((key, k, float(v), None))
+
+        date_obs = values.get('DATE-OBS')
+        if isinstance(date_obs, basestring):
+            try:
+                rows.append((key, 'NIGHT', None, observation_night(date_obs)))
+            except ValueError:
+                pass
+        rows.append((key, 'FRAMETYPE', None, frame_type(values.get('IMAGETYP')) or 'light'))
+
+        self.db.execute('DELETE FROM keywords WHERE path = ?', (key,))
+        self.db.executemany('INSERT INTO keywords VALUES (?, ?, ?, ?)', rows)
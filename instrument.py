@@ -0,0 +1,288 @@
+# Instrumentation for the reduction pipeline
+# Records wall time per stage and per frame, bytes read and written, files
+# opened and cache hits and misses, and reports them as JSON or a table.
+# Recording is off unless enable() is called or PIPELINE_INSTRUMENT is set
+# in the environment; while off every hook returns after one test of a flag.
+#     instrument.enable()
+#     PipeLineSupport.Calibrate(images, cal_path, workers=4)
+#     instrument.print_report()
+# Worker processes of a pool send what they recorded back with their results
+# when pool_map() is used.
+##########
+
+import os
+import json
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+_enabled = bool(os.environ.get('PIPELINE_INSTRUMENT'))
+
+# stage name -> {'calls', 'seconds', 'frames', counter name -> value}
+_stages = OrderedDict()
+
+# [stage, frame, seconds] of every frame
+_frames = []
+
+# counter name -> value, e.g. 'bytes_read', 'header_cache.hits'
+_counters = {}
+
+# names of the stages running now, outermost first
+_active = []
+
+# counters are also updated from the read-ahead threads of fits_access.prefetch
+_lock = threading.Lock()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        del _frames[:]
+        _counters.clear()
+
+
+##########
+# DESCRIPTION
+#   Adds n to a counter, in the totals and in every stage running now. Safe
+#   to call from other threads; their counts go to the stages running in
+#   the main thread, which started them
+# PARAMETERS
+#   name - the counter, e.g. 'bytes_read'
+#   n - the amount
+##########
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+        for s in _active:
+            entry = _stages[s]
+            entry[name] = entry.get(name, 0) + n
+
+
+##########
+# DESCRIPTION
+#   Counts one lookup in a cache
+# PARAMETERS
+#   name - the cache, e.g. 'header_cache'
+#   hit - whether the lookup was served from the cache
+##########
+
+def cache(name, hit):
+    if _enabled:
+        count(name + ('.hits' if hit else '.misses'))
+
+
+##########
+# DESCRIPTION
+#   Decorator that times every call of a stage function. Stages can nest;
+#   the time and counters of an inner stage are also in the outer one
+# PARAMETERS
+#   func - the stage function; its name is the stage name
+##########
+
+def stage(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with _lock:
+            entry = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'frames': 0})
+            entry['calls'] += 1
+            _active.append(name)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _lock:
+                entry['seconds'] += time.time() - start
+                _active.pop()
+
+    return timed
+
+
+##########
+# DESCRIPTION
+#   Decorator factory that times every call of a function working on one
+#   frame, e.g.
+#       @instrument.frame(lambda task: task[3])
+#       def ImArithTask(task):
+#   The frame is credited to the innermost stage running
+# PARAMETERS
+#   name_of - takes the arguments of the call and returns the frame name
+##########
+
+def frame(name_of):
+
+    def decorate(func):
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            owner = _active[-1] if _active else func.__name__
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                with _lock:
+                    _frames.append([owner, str(name_of(*args, **kwargs)), seconds])
+                    if owner in _stages:
+                        _stages[owner]['frames'] += 1
+
+        return timed
+
+    return decorate
+
+
+##########
+# DESCRIPTION
+#   Everything recorded so far, as plain data
+# RETURN
+#   dictionary of 'stages', 'frames' and 'counters'
+##########
+
+def snapshot():
+    with _lock:
+        return {'stages': OrderedDict((k, dict(v)) for k, v in _stages.items()),
+                'frames': [list(f) for f in _frames],
+                'counters': dict(_counters)}
+
+
+##########
+# DESCRIPTION
+#   Adds what another process recorded (a snapshot()) to this one
+# PARAMETERS
+#   recorded - the snapshot
+##########
+
+def merge(recorded):
+    with _lock:
+        for name, values in recorded['stages'].items():
+            entry = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'frames': 0})
+            for k, v in values.items():
+                entry[k] = entry.get(k, 0) + v
+        _frames.extend(recorded['frames'])
+        for k, v in recorded['counters'].items():
+            _counters[k] = _counters.get(k, 0) + v
+
+
+##########
+# DESCRIPTION
+#   pool.map() that also brings back what the workers recorded. While
+#   recording is off it is a plain pool.map()
+# PARAMETERS
+#   pool - a multiprocessing pool
+#   func - module level function taking one task
+#   tasks - list of tasks
+#   chunksize - passed to pool.map
+# RETURN
+#   list of func results in the same order as tasks
+##########
+
+def pool_map(pool, func, tasks, chunksize=None):
+    if not _enabled:
+        return pool.map(func, tasks, chunksize)
+
+    results = []
+    for result, recorded in pool.map(recorded_call, [(func, t, list(_active)) for t in tasks], chunksize):
+        merge(recorded)
+        results.append(result)
+    return results
+
+
+##########
+# DESCRIPTION
+#   runs one pool task with a clean record and returns the record with the
+#   result; the stages running in the parent are credited with its counters
+# PARAMETERS
+#   task - (func, argument, names of the stages running in the parent)
+##########
+
+def recorded_call(task):
+    func, argument, active = task
+    reset()
+    _active[:] = active
+    for name in active:
+        _stages[name] = {'calls': 0, 'seconds': 0.0, 'frames': 0}
+    try:
+        result = func(argument)
+    finally:
+        _active[:] = []
+    return result, snapshot()
+
+
+##########
+# DESCRIPTION
+#   The run report
+# RETURN
+#   dictionary of 'stages' (calls, seconds, frames, seconds per frame and
+#   counters of each), 'frames' ([stage, frame, seconds] of every frame),
+#   'counters' and 'caches' (hits, misses and hit rate of every cache)
+##########
+
+def report():
+    recorded = snapshot()
+    for entry in recorded['stages'].values():
+        frames = entry.get('frames', 0)
+        entry['seconds_per_frame'] = entry['seconds'] / frames if frames else None
+
+    caches = {}
+    for k, v in recorded['counters'].items():
+        name, dot, kind = k.rpartition('.')
+        if dot and kind in ('hits', 'misses'):
+            caches.setdefault(name, {'hits': 0, 'misses': 0})[kind] = v
+    for c in caches.values():
+        lookups = c['hits'] + c['misses']
+        c['hit_rate'] = c['hits'] / float(lookups) if lookups else None
+    recorded['caches'] = caches
+
+    return recorded
+
+
+def write_report(path):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+##########
+# DESCRIPTION
+#   prints the run report as tables of stages, counters and caches
+##########
+
+def print_report():
+    recorded = report()
+    print '%-20s %6s %7s %10s %10s %10s %10s %7s' % ('stage', 'calls', 'frames', 'seconds', 's/frame',
+                                                     'MB read', 'MB written', 'opened')
+    for name, s in recorded['stages'].items():
+        per_frame = '-' if s['seconds_per_frame'] is None else '%.4f' % s['seconds_per_frame']
+        print '%-20s %6d %7d %10.3f %10s %10.1f %10.1f %7d' % (
+            name, s.get('calls', 0), s.get('frames', 0), s.get('seconds', 0.0), per_frame,
+            s.get('bytes_read', 0) / 1024.0**2, s.get('bytes_written', 0) / 1024.0**2,
+            s.get('files_opened', 0))
+
+    print
+    for k in sorted(recorded['counters']):
+        print '%-30s %d' % (k, recorded['counters'][k])
+
+    if recorded['caches']:
+        print
+        print '%-20s %8s %8s %9s' % ('cache', 'hits', 'misses', 'hit rate')
+        for name in sorted(recorded['caches']):
+            c = recorded['caches'][name]
+            rate = '-' if c['hit_rate'] is None else '%.1f%%' % (100 * c['hit_rate'])
+            print '%-20s %8d %8d %9s' % (name, c['hits'], c['misses'], rate)
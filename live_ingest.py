@@ -0,0 +1,136 @@
+# Live ingest for observing nights
+# Watches a night directory and reduces each frame as soon as the camera has
+# finished writing it: the header index is updated, the bias/dark/flat are
+# looked up and the fused calibration is applied.
+##########
+
+import os
+import time
+
+import PipeLineSupport
+from fits_access import fits_complete, frame_type, calibration_products
+from header_index import HeaderIndex
+
+#################       UPDATE PATHS        #################
+
+##########
+# DESCRIPTION
+#   declares the paths and starts watching
+# PARAMETERS
+#   night_path - directory the camera writes the night's frames into
+#   cal_path - top of the calibration tree
+# RETURNS
+#   nothing
+##########
+
+def main():
+    night_path = '/raid/data/home/observatory/data/tonight'
+    cal_path = '/raid/data/home/observatory/data/calibration'
+
+    watch(night_path, cal_path)
+
+
+# seconds between looks at the night directory
+POLL_SECONDS = 0.5
+
+
+##########
+# DESCRIPTION
+#   Watches night_path and calibrates every new science frame once it is
+#   completely written. Bias, dark and flat frames are only indexed. Frames
+#   that already have a calibrated product are skipped, so the watcher can be
+#   restarted during the night. A frame that can't be calibrated (e.g. no
+#   DATE-OBS, or an unreadable master) is reported and not tried again.
+#   Masters rebuilt during the night are picked up within
+#   fits_access.LISTING_SECONDS
+# PARAMETERS
+#   night_path - directory to watch
+#   cal_path - top of the calibration tree
+#   poll - seconds between looks at the directory
+#   once - process what is there now and return instead of watching
+#   bias, dark, flat, normalize - which corrections to apply
+#   index - header index of night_path
+#   waiting - frames seen but not yet completely written
+#   done - frames already handled
+# RETURN
+#   list of calibrated frames written
+##########
+
+def watch(night_path, cal_path, poll=POLL_SECONDS, once=False,
+          bias=True, dark=True, flat=True, normalize=False):
+    index = HeaderIndex(night_path)
+    suffix = ''.join(s for s, on in (('_b', bias), ('_d', dark), ('_f', flat), ('_n', normalize)) if on)
+    waiting = set()
+    done = set()
+    written = []
+
+    try:
+        while True:
+            names = sorted(os.listdir(night_path))
+            products = calibration_products(names)
+            for name in names:
+                stem, ext = os.path.splitext(name)
+                if ext not in ('.fits', '.fit', '.fts') or name in products or name in done:
+                    continue
+
+                x = os.path.join(night_path, name)
+                if not fits_complete(x):
+                    waiting.add(name)
+                    continue
+                waiting.discard(name)
+                done.add(name)
+
+                if os.path.exists(os.path.join(night_path, stem + suffix + '.fits')):
+                    continue
+
+                # a bad frame must not stop the watcher for the rest of the night
+                try:
+                    out = ingest(x, cal_path, index, bias, dark, flat, normalize)
+                except Exception, e:
+                    print '%s: not calibrated, %s: %s' % (x, type(e).__name__, e)
+                    continue
+                if out != "":
+                    written.append(out)
+
+            if once:
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.close()
+
+    if waiting:
+        print 'still being written: ' + ', '.join(sorted(waiting))
+
+    return written
+
+
+##########
+# DESCRIPTION
+#   handles one completely written frame
+# PARAMETERS
+#   x - the new frame
+#   cal_path - top of the calibration tree
+#   index - header index of the night
+#   bias, dark, flat, normalize - which corrections to apply
+#   head - header of the frame, from the index
+#   latency - seconds from the file being written to the calibrated frame
+# RETURN
+#   the calibrated frame, or the null string if it was not calibrated
+##########
+
+def ingest(x, cal_path, index, bias, dark, flat, normalize):
+    head = index.header(x)
+    if frame_type(head.get('IMAGETYP')) is not None:
+        print x + ': calibration frame, indexed'
+        return ""
+
+    out = PipeLineSupport.CalibrateImage(x, cal_path, bias, dark, flat, normalize)
+    latency = time.time() - os.path.getmtime(x)
+    print '%s: %.2f s after write' % (x, latency)
+
+    return out
+
+
+if __name__ == "__main__": main()
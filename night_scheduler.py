@@ -0,0 +1,382 @@
+# Dependency driven reduction of a night
+# The night is modelled as a graph: raw frames are the sources, every master
+# bias/dark/flat depends on its raw frames (and darks and flats on the
+# night's master bias), and every calibrated science frame depends on its raw
+# frame and on the masters it is calibrated with. Each node runs on a process
+# pool as soon as everything it depends on is done, so science frames in one
+# filter don't wait for the flats of another. A dry run prints the plan with
+# the estimated bytes read and written.
+##########
+
+import os
+import Queue
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import PipeLineSupport
+import MasterDark_BiasSub_Test7 as MasterDark
+from fits_access import header_records, observation_night, frame_type, forget_listings
+from fits_access import calibration_products
+from header_index import HeaderIndex
+
+#################       UPDATE PATHS        #################
+
+##########
+# DESCRIPTION
+#   declares the paths, prints the plan and reduces the night
+# PARAMETERS
+#   night_path - directory with the night's raw frames
+#   cal_path - top of the calibration tree
+#   dry_run - only print the plan
+#   plan - the graph of the night, see plan_night()
+# RETURNS
+#   nothing
+##########
+
+def main():
+    night_path = '/raid/data/home/observatory/data/tonight'
+    cal_path = '/raid/data/home/observatory/data/calibration'
+    dry_run = False
+
+    index = HeaderIndex(night_path)
+    plan = plan_night(night_path, cal_path, index=index)
+    index.close()
+
+    print_plan(plan)
+    if not dry_run:
+        run_plan(plan)
+
+
+# header keywords needed to place a raw frame in the graph
+NODE_KEYWORDS = MasterDark.MASTER_KEYWORDS + ['NAXIS1', 'NAXIS2']
+
+# bytes per pixel of the frames the pipeline writes: masters are float64,
+# calibrated frames float32, bad pixel masks uint8
+MASTER_PIXEL_BYTES = 8
+SCIENCE_PIXEL_BYTES = 4
+MASK_PIXEL_BYTES = 1
+
+
+##########
+# DESCRIPTION
+#   Builds the graph of a night. Nodes are dictionaries with
+#       name    - unique name, e.g. 'dark 20140330 180.0' or the raw file
+#       kind    - 'raw', 'master' or 'science'
+#       deps    - names of the nodes it needs
+#       task    - (function, argument) run on the pool; None for raw frames
+#                 and for masters that are up to date
+#       output  - file the node writes
+#       reads, writes - estimated bytes read and written
+#   A science frame depends on the masters of its night built in this plan;
+#   where none is planned it is calibrated with what is already in cal_path
+#   (e.g. the Standard masters), just as the stages would. A master whose
+#   file is newer than its raw frames (and its master bias) is not built
+#   again, so the science frames calibrated with it stay up to date.
+#   Calibrated products of earlier runs in night_path are not raw frames and
+#   are left out
+# PARAMETERS
+#   night_path - directory with the raw frames
+#   cal_path - top of the calibration tree
+#   method - how the masters are combined, see MasterDark.combine()
+#   bias, dark, flat, normalize - which corrections the science frames get
+#   index - header index of night_path (optional)
+#   products - calibrated frames already in night_path
+#   records - header records of the raw frames
+#   groups - raw calibration frames by master
+#   masters - (type, night, exposure or filter) -> name of the master node
+# RETURN
+#   ordered dictionary of name -> node, every node after the ones it needs
+##########
+
+def plan_night(night_path, cal_path, method='median', bias=True, dark=True, flat=True,
+               normalize=True, index=None):
+    names = sorted(os.listdir(night_path))
+    products = calibration_products(names)
+    images = [i for i in MasterDark.sort(names) if i not in products]
+    if index is not None:
+        records = index.records(images, NODE_KEYWORDS, night_path)
+    else:
+        records = header_records(images, NODE_KEYWORDS, night_path)
+
+    plan = {}
+    pixels = {}
+    for i, r in zip(images, records):
+        x = os.path.join(night_path, i)
+        plan[x] = {'name': x, 'kind': 'raw', 'deps': [], 'task': None, 'output': x,
+                   'reads': 0, 'writes': 0}
+        pixels[x] = (r['NAXIS1'] or 0) * (r['NAXIS2'] or 0)
+
+    groups = MasterDark.calibration_groups(images, records, night_path)
+    masters = {}
+    for key in sorted(groups):
+        kind, night, value = key
+        name = ' '.join(str(k) for k in key if k is not None)
+        files = groups[key]
+        output = MasterDark.master_path(cal_path, *key)
+        npix = pixels[files[0]]
+        writes = npix * MASTER_PIXEL_BYTES
+        if kind == 'dark':
+            writes = writes + npix * MASK_PIXEL_BYTES
+        plan[name] = {'name': name, 'kind': 'master', 'deps': list(files), 'output': output,
+                      'reads': sum(os.path.getsize(f) for f in files), 'writes': writes,
+                      'task': (MasterDark.build_group, (key, files, output, method, None, None))}
+        masters[key] = name
+
+    # darks and flats are combined with their night's master bias subtracted
+    for key, name in masters.items():
+        bias_name = masters.get(('bias', key[1], None))
+        if key[0] != 'bias' and bias_name is not None:
+            node = plan[name]
+            node['deps'].append(bias_name)
+            node['reads'] += plan[bias_name]['writes']
+            build, task = node['task']
+            node['task'] = (build, task[:4] + (plan[bias_name]['output'],) + task[5:])
+
+    # biases sort first, so a dark or flat sees whether its bias is rebuilt
+    for key in sorted(masters):
+        node = plan[masters[key]]
+        if master_up_to_date(node, plan):
+            node['task'] = None
+            node['reads'] = node['writes'] = 0
+
+    for i, r in zip(images, records):
+        x = os.path.join(night_path, i)
+        if frame_type(r['IMAGETYP']) is not None:
+            continue
+        try:
+            night = observation_night(r['DATE-OBS'])
+        except (TypeError, ValueError):
+            print x + ': no valid DATE-OBS, not calibrated'
+            continue
+        wanted = []
+        if bias:
+            wanted.append(('bias', night, None))
+        if dark:
+            wanted.append(('dark', night, r['EXPTIME']))
+        if flat:
+            wanted.append(('flat', night, r['FILTER']))
+        deps = [masters[k] for k in wanted if k in masters]
+
+        output = PipeLineSupport.CalibratedName(x, bias, dark, flat, normalize)
+        name = os.path.basename(output)
+        plan[name] = {'name': name, 'kind': 'science', 'deps': [x] + deps, 'output': output,
+                      'reads': os.path.getsize(x) + sum(master_bytes(plan[d]) for d in deps),
+                      'writes': pixels[x] * SCIENCE_PIXEL_BYTES,
+                      'task': (calibrate_frame, (x, cal_path, bias, dark, flat, normalize,
+                                                 [plan[d]['output'] for d in deps]))}
+
+    return topological(plan)
+
+
+##########
+# DESCRIPTION
+#   whether a master node's file is already there and newer than every
+#   file it is made from, with every master it needs up to date as well
+# PARAMETERS
+#   node - the master node
+#   plan - dictionary of name -> node
+#   built - mtime of the master's file
+##########
+
+def master_up_to_date(node, plan):
+    try:
+        built = os.path.getmtime(node['output'])
+    except OSError:
+        return False
+    for d in node['deps']:
+        dep = plan[d]
+        if dep['kind'] == 'master' and dep['task'] is not None:
+            return False
+        if os.path.getmtime(dep['output']) > built:
+            return False
+    return True
+
+
+##########
+# DESCRIPTION
+#   bytes a science frame reads from one of its masters: the file if it is
+#   up to date, else the estimate of what will be written
+##########
+
+def master_bytes(node):
+    if node['task'] is None:
+        return os.path.getsize(node['output'])
+    return node['writes']
+
+
+##########
+# DESCRIPTION
+#   orders the nodes so each comes after every node it needs
+# PARAMETERS
+#   plan - dictionary of name -> node
+#   state - name -> 1 while being visited, 2 once placed
+# RETURN
+#   ordered dictionary of name -> node; raises ValueError on a cycle
+##########
+
+def topological(plan):
+    ordered = OrderedDict()
+    state = {}
+
+    def visit(name):
+        if state.get(name) == 2:
+            return
+        if state.get(name) == 1:
+            raise ValueError('cycle through ' + name)
+        state[name] = 1
+        for d in plan[name]['deps']:
+            visit(d)
+        state[name] = 2
+        ordered[name] = plan[name]
+
+    kinds = {'raw': 0, 'master': 1, 'science': 2}
+    for name in sorted(plan, key=lambda n: (kinds[plan[n]['kind']], n)):
+        visit(name)
+    return ordered
+
+
+##########
+# DESCRIPTION
+#   prints the plan: every master and science node with what it waits for
+#   and its estimated I/O, then the totals
+# PARAMETERS
+#   plan - the graph, see plan_night()
+##########
+
+def print_plan(plan):
+    reads = writes = 0
+    counts = {'raw': 0, 'master': 0, 'science': 0}
+    for node in plan.values():
+        counts[node['kind']] += 1
+        if node['kind'] == 'raw':
+            continue
+        if node['task'] is None:
+            print '%-8s %-35s up to date' % (node['kind'], node['name'])
+            continue
+        reads += node['reads']
+        writes += node['writes']
+        waits = [d for d in node['deps'] if plan[d]['task'] is not None]
+        print '%-8s %-35s read %8.1f MB  write %8.1f MB  after: %s' % (
+            node['kind'], node['name'], node['reads'] / 1024.0**2, node['writes'] / 1024.0**2,
+            ', '.join(waits) or '-')
+
+    print '%d raw frames, %d masters, %d science frames' % (counts['raw'], counts['master'],
+                                                              counts['science'])
+    print 'estimated %.1f MB read, %.1f MB written' % (reads / 1024.0**2, writes / 1024.0**2)
+
+
+##########
+# DESCRIPTION
+#   Runs the plan on a process pool. A node is handed to the pool as soon as
+#   every node it needs has finished; a node that failed still releases the
+#   nodes after it, which then fall back to the masters already in cal_path.
+#   Nodes without a task (raw frames, masters up to date) count as finished
+# PARAMETERS
+#   plan - the graph, see plan_night()
+#   processes - size of the process pool (default: one per cpu)
+#   finished - queue of (name, output, error) sent back by the pool
+#   waiting - name -> names of the nodes it still waits for
+#   after - name -> names of the nodes waiting for it
+# RETURN
+#   dictionary of name -> output written ('' where nothing was written)
+##########
+
+def run_plan(plan, processes=None):
+    finished = Queue.Queue()
+    waiting = {}
+    after = {}
+    for name, node in plan.items():
+        waiting[name] = set(d for d in node['deps'] if plan[d]['task'] is not None)
+        for d in waiting[name]:
+            after.setdefault(d, []).append(name)
+
+    results = {}
+    running = [0]
+    pool = multiprocessing.Pool(processes)
+
+    def submit(name):
+        running[0] += 1
+        pool.apply_async(run_node, ((name, plan[name]['task']),), callback=finished.put)
+
+    try:
+        for name, node in plan.items():
+            if node['task'] is not None and not waiting[name]:
+                submit(name)
+
+        while running[0]:
+            # a timeout keeps Ctrl-C working while waiting
+            try:
+                name, output, error = finished.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            running[0] -= 1
+            results[name] = output or ''
+            if error is not None:
+                print '%s failed:\n%s' % (name, error)
+
+            for n in after.get(name, []):
+                waiting[n].discard(name)
+                if not waiting[n]:
+                    submit(n)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+##########
+# DESCRIPTION
+#   runs one node in a pool worker; errors are sent back rather than raised
+#   so the scheduler learns the node is done
+# PARAMETERS
+#   item - (node name, (function, argument))
+# RETURN
+#   (name, what the function returned, traceback text or None)
+##########
+
+def run_node(item):
+    name, (function, argument) = item
+    try:
+        return name, function(argument), None
+    except Exception:
+        return name, None, traceback.format_exc()
+
+
+##########
+# DESCRIPTION
+#   Calibrates one science frame with the fused calibration, unless its
+#   output is up to date (see PipeLineSupport.OutputUnchanged). The masters
+#   it waited for are looked up on disk, not in this worker's listings
+# PARAMETERS
+#   task - (image, cal_path, bias, dark, flat, normalize, list of the master
+#          frames this image waited for)
+#   frames - the bias, dark and flat the image is calibrated with
+# RETURN
+#   the calibrated image, or the null string
+##########
+
+def calibrate_frame(task):
+    image, cal_path, bias, dark, flat, normalize, masters = task
+
+    # the masters were written by other pool workers, maybe after this one
+    # listed their directory or cached an older version of them
+    forget_listings(masters)
+    PipeLineSupport.InvalidateCalibrationCache(masters)
+
+    frames = PipeLineSupport.CalibrationFrames(image, cal_path, bias, dark, flat)
+    if frames is None:
+        return ''
+
+    source = ([image] + [f for f in frames if f is not None], {})
+    output = PipeLineSupport.CalibratedName(image, bias, dark, flat, normalize)
+    if PipeLineSupport.OutputUnchanged(output, *source):
+        return output
+
+    output = PipeLineSupport.CalibrateImage(image, cal_path, bias, dark, flat, normalize)
+    PipeLineSupport.RecordProvenance([output], [source])
+    return output
+
+
+if __name__ == "__main__": main()
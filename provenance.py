@@ -0,0 +1,121 @@
+# Provenance of calibrated frames
+# Remembers, for every output a calibration stage writes, which files it was
+# made from (the raw frame and the bias/dark/flat that was picked) with their
+# size and mtime, and the parameters of the operation. A re-run can then skip
+# a frame whose output is still there and whose inputs have not changed, and
+# redo only the frames that depend on a new master.
+##########
+
+import os
+import json
+import sqlite3
+
+# name of the provenance file created in the output directory
+PROVENANCE_NAME = '.provenance.sqlite'
+
+
+##########
+# DESCRIPTION
+#   what a file is recognised by: its absolute path, size and mtime
+# PARAMETERS
+#   x - the file
+# RETURN
+#   [path, size, mtime], or None if the file doesn't exist
+##########
+
+def signature(x):
+    key = os.path.abspath(x)
+    try:
+        st = os.stat(key)
+    except OSError:
+        return None
+    return [key, st.st_size, st.st_mtime]
+
+
+class ProvenanceStore(object):
+
+    ##########
+    # DESCRIPTION
+    #   Opens (or creates) the provenance file of an output directory
+    # PARAMETERS
+    #   path - the output directory
+    #   filename - name of the provenance file inside path
+    ##########
+
+    def __init__(self, path, filename=PROVENANCE_NAME):
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, filename))
+        self.db.execute('CREATE TABLE IF NOT EXISTS outputs ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inputs TEXT, params TEXT)')
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ##########
+    # DESCRIPTION
+    #   Checks whether an output is up to date: it was recorded, it hasn't
+    #   been touched since, it was made with the same parameters and every
+    #   input still has the size and mtime it had then
+    # PARAMETERS
+    #   output - the output file
+    #   inputs - list of files the output is made from
+    #   params - dictionary of the parameters of the operation
+    # RETURN
+    #   True if the output doesn't need to be made again
+    ##########
+
+    def unchanged(self, output, inputs, params):
+        row = self.db.execute('SELECT size, mtime, inputs, params FROM outputs WHERE path = ?',
+                              (os.path.abspath(output),)).fetchone()
+        if row is None:
+            return False
+
+        current = signature(output)
+        if current is None or current[1:] != [row[0], row[1]]:
+            return False
+        if row[3] != json.dumps(params, sort_keys=True):
+            return False
+        return json.loads(row[2]) == [signature(i) for i in inputs]
+
+    ##########
+    # DESCRIPTION
+    #   Records what an output that was just written is made from
+    # PARAMETERS
+    #   output - the output file
+    #   inputs - list of files the output is made from
+    #   params - dictionary of the parameters of the operation
+    #   commit - write the change to disk straight away
+    ##########
+
+    def record(self, output, inputs, params, commit=True):
+        current = signature(output)
+        if current is None:
+            return
+        self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                        (current[0], current[1], current[2],
+                         json.dumps([signature(i) for i in inputs]),
+                         json.dumps(params, sort_keys=True)))
+        if commit:
+            self.db.commit()
+
+    ##########
+    # DESCRIPTION
+    #   Drops the records of outputs, so they are made again on the next run
+    # PARAMETERS
+    #   outputs - list of output files
+    ##########
+
+    def forget(self, outputs):
+        for o in outputs:
+            self.db.execute('DELETE FROM outputs WHERE path = ?', (os.path.abspath(o),))
+        self.db.commit()
@@ -0,0 +1,379 @@
+# Distributed reduction through a shared work queue
+# A coordinator splits the frames into work units and puts them in an SQLite
+# queue file on a filesystem every node can see. Workers on any number of
+# nodes claim units one at a time and run the existing calibration stages on
+# them. A claimed unit is leased: the worker renews the lease while it works,
+# and if the worker dies the lease runs out and another worker claims the
+# unit again, up to MAX_ATTEMPTS times. Outputs that are already up to date
+# are skipped by the stages, so a retried unit only redoes what is missing.
+# SQLite locking needs a filesystem with working POSIX locks (local disks,
+# NFSv4 with locking enabled).
+#     work_queue.py submit queue.sqlite cal_path frame1.fits frame2.fits ...
+#     work_queue.py work queue.sqlite                    (on every node)
+#     work_queue.py local queue.sqlite 4                 (4 local workers)
+##########
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+
+import PipeLineSupport
+
+# frames in one work unit
+UNIT_FRAMES = 16
+
+# seconds a claim lasts without being renewed
+LEASE_SECONDS = 120.0
+
+# times a unit is tried before it is marked failed
+MAX_ATTEMPTS = 3
+
+# seconds between looks at the queue when nothing can be claimed
+POLL_SECONDS = 2.0
+
+
+##########
+# DESCRIPTION
+#   command line: submit frames, run a worker, or run workers on this machine
+#   and report
+# RETURNS
+#   nothing
+##########
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('submit', 'work', 'local', 'status'):
+        print 'usage: work_queue.py submit QUEUE CAL_PATH FRAME... | work QUEUE | local QUEUE N | status QUEUE'
+        return
+
+    command, queue_path = sys.argv[1], sys.argv[2]
+    if command == 'submit':
+        added = submit(queue_path, sys.argv[4:], sys.argv[3])
+        print '%d work units added' % added
+    elif command == 'work':
+        work(queue_path)
+    elif command == 'local':
+        run_local(queue_path, int(sys.argv[3]))
+
+    with WorkQueue(queue_path) as queue:
+        print queue.counts()
+
+
+##########
+# DESCRIPTION
+#   what the workers run: stage name -> function taking the unit's payload
+#   and returning the list of frames written
+##########
+
+def run_calibrate(p):
+    return PipeLineSupport.Calibrate(p['images'], p['cal_path'], p['bias'], p['dark'], p['flat'],
+                                     p['normalize'], batch=p.get('batch', False))
+
+def run_bias(p):
+    return PipeLineSupport.BiasSubtract(p['images'], p['cal_path'], backend=p.get('backend'))
+
+def run_dark(p):
+    return PipeLineSupport.DarkSubtract(p['images'], p['cal_path'], backend=p.get('backend'))
+
+def run_flat(p):
+    return PipeLineSupport.FlatField(p['images'], p['cal_path'], backend=p.get('backend'))
+
+def run_normalize(p):
+    return PipeLineSupport.ExpNormalize(p['images'], backend=p.get('backend'))
+
+STAGES = {'Calibrate': run_calibrate,
+          'BiasSubtract': run_bias,
+          'DarkSubtract': run_dark,
+          'FlatField': run_flat,
+          'ExpNormalize': run_normalize}
+
+
+class WorkQueue(object):
+
+    ##########
+    # DESCRIPTION
+    #   Opens (or creates) the queue file
+    # PARAMETERS
+    #   path - the queue file
+    #   timeout - seconds to wait for another process's lock
+    ##########
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS units ('
+                        'id INTEGER PRIMARY KEY, stage TEXT, payload TEXT, state TEXT, '
+                        'attempts INTEGER, worker TEXT, lease_until REAL, result TEXT, error TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until)')
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ##########
+    # DESCRIPTION
+    #   Adds work units, all pending
+    # PARAMETERS
+    #   stage - a key of STAGES
+    #   payloads - list of payload dictionaries, one per unit
+    # RETURN
+    #   number of units added
+    ##########
+
+    def add(self, stage, payloads):
+        if stage not in STAGES:
+            raise ValueError('unknown stage %r' % stage)
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany('INSERT INTO units (stage, payload, state, attempts) VALUES (?, ?, ?, 0)',
+                            [(stage, json.dumps(p), 'pending') for p in payloads])
+        self.db.execute('COMMIT')
+        return len(payloads)
+
+    ##########
+    # DESCRIPTION
+    #   Claims the next unit that is pending, or leased by a worker whose
+    #   lease ran out. The write lock is taken before looking, so two workers
+    #   never claim the same unit. A unit whose lease ran out on its last
+    #   attempt is marked failed instead
+    # PARAMETERS
+    #   worker - name of the claiming worker
+    #   lease - seconds the claim lasts without being renewed
+    # RETURN
+    #   (unit id, stage, payload), or None if nothing can be claimed now
+    ##########
+
+    def claim(self, worker, lease=LEASE_SECONDS):
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute("UPDATE units SET state = 'failed', error = 'lease expired' "
+                            "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                            (now, MAX_ATTEMPTS))
+            row = self.db.execute("SELECT id, stage, payload FROM units "
+                                  "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                                  "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE units SET state = 'leased', worker = ?, lease_until = ?, "
+                                "attempts = attempts + 1 WHERE id = ?", (worker, now + lease, row[0]))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    ##########
+    # DESCRIPTION
+    #   Extends the lease of a unit the worker still holds
+    # PARAMETERS
+    #   unit - unit id
+    #   worker - name of the worker
+    #   lease - seconds from now the claim lasts
+    # RETURN
+    #   False if the unit was taken over by another worker
+    ##########
+
+    def renew(self, unit, worker, lease=LEASE_SECONDS):
+        cursor = self.db.execute("UPDATE units SET lease_until = ? "
+                                 "WHERE id = ? AND worker = ? AND state = 'leased'",
+                                 (time.time() + lease, unit, worker))
+        return cursor.rowcount == 1
+
+    ##########
+    # DESCRIPTION
+    #   Marks a unit done with the frames it wrote. Ignored if the unit has
+    #   been taken over by another worker meanwhile
+    # PARAMETERS
+    #   unit - unit id
+    #   worker - name of the worker
+    #   result - list of frames written
+    ##########
+
+    def complete(self, unit, worker, result):
+        self.db.execute("UPDATE units SET state = 'done', result = ?, error = NULL "
+                        "WHERE id = ? AND worker = ? AND state = 'leased'",
+                        (json.dumps(result), unit, worker))
+
+    ##########
+    # DESCRIPTION
+    #   Gives a unit back after an error; it becomes pending again, or failed
+    #   once it has been tried MAX_ATTEMPTS times
+    # PARAMETERS
+    #   unit - unit id
+    #   worker - name of the worker
+    #   error - description of the error
+    ##########
+
+    def fail(self, unit, worker, error):
+        self.db.execute("UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                        "error = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                        (MAX_ATTEMPTS, error, unit, worker))
+
+    ##########
+    # DESCRIPTION
+    #   number of units in every state
+    # RETURN
+    #   dictionary of state -> count
+    ##########
+
+    def counts(self):
+        return dict(self.db.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall())
+
+    ##########
+    # DESCRIPTION
+    #   whether any unit is still pending or being worked on
+    ##########
+
+    def unfinished(self):
+        row = self.db.execute("SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()
+        return row[0] > 0
+
+    ##########
+    # DESCRIPTION
+    #   frames written by all the finished units, in unit order
+    ##########
+
+    def results(self):
+        written = []
+        for row in self.db.execute("SELECT result FROM units WHERE state = 'done' ORDER BY id"):
+            written.extend(json.loads(row[0]))
+        return written
+
+
+##########
+# DESCRIPTION
+#   Splits frames into work units and adds them to the queue
+# PARAMETERS
+#   queue_path - the queue file
+#   images - list of frames to reduce
+#   cal_path - top of the calibration tree, as the workers see it
+#   stage - a key of STAGES
+#   unit_frames - frames in one work unit
+#   options - further payload entries, e.g. bias=False or backend='numpy';
+#             Calibrate defaults to every correction
+# RETURN
+#   number of units added
+##########
+
+def submit(queue_path, images, cal_path, stage='Calibrate', unit_frames=UNIT_FRAMES, **options):
+    payload = {'cal_path': os.path.abspath(cal_path)}
+    if stage == 'Calibrate':
+        payload.update({'bias': True, 'dark': True, 'flat': True, 'normalize': True})
+    payload.update(options)
+
+    images = [os.path.abspath(i) for i in images]
+    payloads = []
+    for n in range(0, len(images), unit_frames):
+        payloads.append(dict(payload, images=images[n:n + unit_frames]))
+
+    with WorkQueue(queue_path) as queue:
+        return queue.add(stage, payloads)
+
+
+##########
+# DESCRIPTION
+#   Worker loop: claims units and runs their stage until the queue has no
+#   unfinished units left (or forever, with wait). A background thread
+#   renews the lease while a unit runs, so long units are not taken over
+#   as long as the worker is alive
+# PARAMETERS
+#   queue_path - the queue file
+#   worker - name of this worker (default: host:pid)
+#   lease - seconds a claim lasts without being renewed
+#   poll - seconds between looks at the queue when nothing can be claimed
+#   wait - keep waiting for new units when the queue is finished
+#   done - set when the current unit has finished, stops the renewals
+# RETURN
+#   number of units this worker finished
+##########
+
+def work(queue_path, worker=None, lease=LEASE_SECONDS, poll=POLL_SECONDS, wait=False):
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    finished = 0
+
+    with WorkQueue(queue_path) as queue:
+        while True:
+            claimed = queue.claim(worker, lease)
+            if claimed is None:
+                if not wait and not queue.unfinished():
+                    break
+                time.sleep(poll)
+                continue
+
+            unit, stage, payload = claimed
+            done = threading.Event()
+            renewer = threading.Thread(target=renew_lease, args=(queue_path, unit, worker, lease, done))
+            renewer.daemon = True
+            renewer.start()
+            try:
+                result = STAGES[stage](payload)
+            except Exception:
+                done.set()
+                renewer.join()
+                queue.fail(unit, worker, traceback.format_exc())
+                continue
+
+            done.set()
+            renewer.join()
+            queue.complete(unit, worker, result)
+            finished += 1
+
+    return finished
+
+
+##########
+# DESCRIPTION
+#   renews a lease every third of its length until done is set; runs in a
+#   thread of the worker with its own connection
+# PARAMETERS
+#   queue_path, unit, worker, lease - the claim to renew
+#   done - event set when the unit has finished
+##########
+
+def renew_lease(queue_path, unit, worker, lease, done):
+    with WorkQueue(queue_path) as queue:
+        while not done.wait(lease / 3.0):
+            if not queue.renew(unit, worker, lease):
+                return
+
+
+##########
+# DESCRIPTION
+#   Runs workers as local processes standing in for nodes, and waits for
+#   them
+# PARAMETERS
+#   queue_path - the queue file
+#   workers - number of worker processes
+#   lease, poll - passed to work()
+# RETURN
+#   the queue's counts() once the workers have exited
+##########
+
+def run_local(queue_path, workers, lease=LEASE_SECONDS, poll=POLL_SECONDS):
+    processes = []
+    for n in range(workers):
+        name = '%s:local%d' % (socket.gethostname(), n)
+        p = multiprocessing.Process(target=work, args=(queue_path, name, lease, poll))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+    with WorkQueue(queue_path) as queue:
+        return queue.counts()
+
+
+if __name__ == "__main__": main()